@@ -1,6 +1,10 @@
-from pendo.llms import Message, MessageRole, BaseLlm
+from pendo.llms import Message, MessageDelta, MessageRole, BaseLlm
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+
 import asyncio
-import itertools
+import heapq
+import numpy as np
 
 _PROMPT = """
         Follow exactly those 3 steps:
@@ -14,7 +18,7 @@ _PROMPT = """
         """
 
 class PerplexitySearchAgent():
-    def __init__(self, llm: BaseLlm, tokenizer, summary_index, chunk_index, temperature=0.5, shortlisting_threshold = 0.8, n_summary_results=20, n_chunk_results=50, max_context_tokens=12288):
+    def __init__(self, llm: BaseLlm, tokenizer, summary_index, chunk_index, temperature=0.5, shortlisting_threshold = 0.8, n_summary_results=20, n_chunk_results=50, max_context_tokens=12288, token_cache_size=4096, skip_expansion_distance=None, search_workers=8, max_sessions=32):
         self.llm = llm
         self.tokenizer = tokenizer
         self.summary_index = summary_index
@@ -24,62 +28,103 @@ class PerplexitySearchAgent():
         self.n_summary_results = n_summary_results
         self.n_chunk_results = n_chunk_results
         self.max_context_tokens = max_context_tokens
-
-    def _generate_search_queries(self, query):
+        # Skip query expansion when the raw question alone finds a doc this close (None to always expand)
+        self.skip_expansion_distance = skip_expansion_distance
+        # Vector searches of all sessions share a bounded pool, served in submission order,
+        # and sessions beyond max_sessions wait their turn in arrival order
+        self.search_executor = ThreadPoolExecutor(max_workers=search_workers, thread_name_prefix="agent-search")
+        self.sessions = asyncio.Semaphore(max_sessions)
+        # Fallback for chunks indexed without a num_tokens count
+        self._count_tokens = lru_cache(maxsize=token_cache_size)(lambda text: len(self.tokenizer.encode(text)))
+
+    async def _generate_search_queries(self, query):
         messages = [Message(MessageRole.SYSTEM, "Generate search engine queries for the question that the user is asking. Return the queries in the form of a list separated by ; . For example, if the user asks 'What is the capital of France?', you can return 'capital of France; France capital city'. Return the queries only, do not answer the question directly. Return no more than 6 queries.\n")]
         messages.append(Message(MessageRole.USER, query))
-        reply, usage = self.llm.chat_completion(messages, temperature=0.5)
+        reply, usage = await self.llm.chat_completion_async(messages, temperature=0.5)
 
         return reply.content.split(";"), usage
 
-    async def _retrieve_relevant_docs(self, query):
-        candidates = self.summary_index.query(query_texts=[query], n_results=self.n_summary_results)
-        
-        docs = []
-        for idx, doc_id, distance, metadata in zip(range(1, self.n_summary_results+1), candidates["ids"][0], candidates["distances"][0], candidates["metadatas"][0]):
-            score = 1.0/idx
-            docs.append({"id": doc_id, "score": score, "distance": distance, "metadata": metadata})
-        return docs
-    
-    async def _retrieve_shortlisted_docs(self, quries):
-        agg_candidates = await asyncio.gather(*(self._retrieve_relevant_docs(q) for q in quries))
-
-        doc_candidates = {}
-        for cand in itertools.chain(*agg_candidates):
-            if cand["id"] not in doc_candidates:
-                doc_candidates[cand["id"]] = cand
-                doc_candidates[cand["id"]].pop("distance")
-            else:
-                doc_candidates[cand["id"]]["score"] += cand["score"]
-        doc_candidates = list(doc_candidates.values())
-        doc_candidates.sort(key=lambda x: x["score"], reverse=True)
+    async def _query(self, index, **kwargs):
+        # Chroma queries block, so they run off the event loop
+        return await asyncio.get_running_loop().run_in_executor(self.search_executor, partial(index.query, **kwargs))
+
+    async def _search_summaries(self, queries):
+        queries = [q.strip() for q in queries if len(q.strip()) > 0]
+        if len(queries) == 0:
+            return {"ids": [], "distances": [], "metadatas": []}
+        # One batched embedding and search for all queries
+        return await self._query(self.summary_index, query_texts=queries, n_results=self.n_summary_results)
+
+    def _fuse_candidates(self, candidates):
+        ids = [doc_id for row in candidates["ids"] for doc_id in row]
+        if len(ids) == 0:
+            return []
+        metadatas = [metadata for row in candidates["metadatas"] for metadata in row]
+        distances = np.array([distance for row in candidates["distances"] for distance in row], dtype=float)
+        ranks = np.concatenate([np.arange(1, len(row)+1) for row in candidates["ids"]])
+
+        # Reciprocal rank fusion over the flattened (query, rank) result matrix
+        unique_ids, first_index, inverse = np.unique(np.array(ids), return_index=True, return_inverse=True)
+        inverse = inverse.ravel()
+        scores = np.bincount(inverse, weights=1.0/ranks)
+        best_distances = np.full(len(unique_ids), np.inf)
+        np.minimum.at(best_distances, inverse, distances)
+
+        # Order by score, breaking ties by first appearance
+        order = np.argsort(first_index, kind="stable")
+        order = order[np.argsort(-scores[order], kind="stable")]
+        return [{"id": ids[first_index[i]], "score": float(scores[i]), "distance": float(best_distances[i]), "metadata": metadatas[first_index[i]]} for i in order]
+
+    def _shortlist(self, doc_candidates):
+        if len(doc_candidates) == 0:
+            return []
 
         threshold = doc_candidates[0]["score"] - self.shortlisting_threshold * (doc_candidates[0]["score"] - doc_candidates[-1]["score"])
         return [cand for cand in doc_candidates if cand["score"] >= threshold]
 
-    async def _retrieve_snippets_from_doc(self, query, doc_id):
-        results = self.chunk_index.query(query_texts=[query], where={"doc_id": {"$eq": doc_id}}, n_results=self.n_chunk_results)
-        snippets = []
-        for sid, distance, metadata, document in list(zip(results["ids"][0], results["distances"][0], results["metadatas"][0], results["documents"][0])):
-            doc_id = metadata["doc_id"]
-            snippets.append({
+    async def _retrieve_relevant_docs(self, queries):
+        return self._fuse_candidates(await self._search_summaries(queries))
+
+    async def _retrieve_shortlisted_docs(self, quries):
+        return self._shortlist(await self._retrieve_relevant_docs(quries))
+
+    async def _retrieve_snippets_from_docs(self, query, doc_ids):
+        if len(doc_ids) == 0:
+            return []
+        # One embedding and one search over all candidate docs, instead of one per doc
+        results = await self._query(self.chunk_index, query_texts=[query], where={"doc_id": {"$in": list(doc_ids)}}, n_results=self.n_chunk_results * len(doc_ids))
+        doc_snippets = {}
+        for sid, distance, metadata, document in zip(results["ids"][0], results["distances"][0], results["metadatas"][0], results["documents"][0]):
+            doc_snippets.setdefault(metadata["doc_id"], []).append({
                 "id": sid,
                 "distance": distance,
                 "content": document,
                 "metadata": metadata,
             })
-        return snippets
 
-    async def _retrieve_relevant_snippets(self, query, shortlisted_doc_ids):
-        agg_snippets = await asyncio.gather(*(self._retrieve_snippets_from_doc(query, doc_id) for doc_id in shortlisted_doc_ids))
-        snippets = [s for s in itertools.chain(*agg_snippets)]
-        snippets.sort(key=lambda x: x["distance"])
+        # Keep the top n_chunk_results of every doc, merged by distance
+        top_snippets = [heapq.nsmallest(self.n_chunk_results, snippets, key=lambda x: x["distance"]) for snippets in doc_snippets.values()]
+        return list(heapq.merge(*top_snippets, key=lambda x: x["distance"]))
+
+    async def _retrieve_relevant_snippets(self, query, shortlisted_doc_ids, prefetched_snippets=None):
+        # Snippets already retrieved for some of the docs are merged instead of searched again
+        if prefetched_snippets is None:
+            snippets = await self._retrieve_snippets_from_docs(query, shortlisted_doc_ids)
+        else:
+            prefetched_doc_ids, prefetched_snippets = prefetched_snippets
+            wanted = set(shortlisted_doc_ids)
+            prefetched_snippets = [s for s in prefetched_snippets if s["metadata"]["doc_id"] in wanted]
+            new_snippets = await self._retrieve_snippets_from_docs(query, [doc_id for doc_id in shortlisted_doc_ids if doc_id not in prefetched_doc_ids])
+            snippets = list(heapq.merge(prefetched_snippets, new_snippets, key=lambda x: x["distance"]))
 
         doc_ids = set()
         shortlisted_snippets = []
         current_tokens = 0
         for snippet in snippets:
-            current_tokens += len(self.tokenizer.encode(snippet["content"]))
+            num_tokens = snippet["metadata"].get("num_tokens", None)
+            if num_tokens is None:
+                num_tokens = self._count_tokens(snippet["content"])
+            current_tokens += num_tokens
             if current_tokens > self.max_context_tokens:
                 break
             doc_ids.add(snippet["metadata"]["doc_id"])
@@ -95,11 +140,42 @@ class PerplexitySearchAgent():
 
 
 
-    async def run(self, query):
-        search_queries, usage = self._generate_search_queries(query)
-        yield Message(MessageRole.SYSTEM, f"Expanding your queries: \n {';'.join(search_queries)}\n"), usage
+    def close(self):
+        self.search_executor.shutdown(wait=False)
 
-        shortlisted_docs = await self._retrieve_shortlisted_docs(search_queries)
+    async def run(self, query):
+        async with self.sessions:
+            async for result in self._run(query):
+                yield result
+
+    async def _run(self, query):
+        # Search with the raw question while the llm expands it, then fold the expanded results in
+        expansion = asyncio.ensure_future(self._generate_search_queries(query))
+        speculative_snippets = None
+        try:
+            raw_candidates = await self._search_summaries([query])
+            raw_docs = self._shortlist(self._fuse_candidates(raw_candidates))
+            raw_doc_ids = set([doc["id"] for doc in raw_docs])
+
+            if self.skip_expansion_distance is not None and len(raw_docs) > 0 and raw_docs[0]["distance"] <= self.skip_expansion_distance:
+                expansion.cancel()
+                yield Message(MessageRole.SYSTEM, "Found close matches for your question, skipping query expansion\n"), None
+                shortlisted_docs = raw_docs
+                snippets = await self._retrieve_relevant_snippets(query, [doc["id"] for doc in shortlisted_docs])
+            else:
+                speculative_snippets = asyncio.ensure_future(self._retrieve_snippets_from_docs(query, raw_doc_ids))
+                search_queries, usage = await expansion
+                yield Message(MessageRole.SYSTEM, f"Expanding your queries: \n {';'.join(search_queries)}\n"), usage
+
+                expanded_candidates = await self._search_summaries(search_queries)
+                candidates = {k: raw_candidates[k] + expanded_candidates[k] for k in ["ids", "distances", "metadatas"]}
+                shortlisted_docs = self._shortlist(self._fuse_candidates(candidates))
+                prefetched = (raw_doc_ids, await speculative_snippets)
+                snippets = await self._retrieve_relevant_snippets(query, [doc["id"] for doc in shortlisted_docs], prefetched)
+        finally:
+            for task in [expansion, speculative_snippets]:
+                if task is not None and not task.done():
+                    task.cancel()
 
         if len(shortlisted_docs) == 0:
             yield Message(MessageRole.SYSTEM, "No relevant documents found.\n"), None
@@ -110,7 +186,6 @@ class PerplexitySearchAgent():
             message += f"{doc['score']:.2f} \t {doc['metadata']['title']}\n"
         yield Message(MessageRole.SYSTEM, message), None
 
-        snippets = await self._retrieve_relevant_snippets(query, [doc["id"] for doc in shortlisted_docs])
         context = []
         for idx, doc in enumerate(shortlisted_docs):
             if snippets.get(doc["id"], None) is None:
@@ -121,4 +196,7 @@ class PerplexitySearchAgent():
         messages.append(Message(MessageRole.SYSTEM, _PROMPT))
         messages.append(Message(MessageRole.USER, query))
 
-        yield self.llm.chat_completion(messages, temperature=self.temperature)
\ No newline at end of file
+        stream = await self.llm.chat_completion_stream_async(messages, temperature=self.temperature)
+        async for delta in stream:
+            yield MessageDelta(MessageRole.ASSISTANT, delta), None
+        yield stream.reply_message, stream.usage
\ No newline at end of file
@@ -1,2 +1,4 @@
-from .paths import initialize_workspace_paths, WORKSPACE_PATH, CONFIG_PATH, CHROMA_PATH, TIMESTAMPS_PATH
-from .config import load_config
\ No newline at end of file
+from .paths import initialize_workspace_paths, WORKSPACE_PATH, CONFIG_PATH, CHROMA_PATH, TIMESTAMPS_PATH, CACHE_PATH, SOCKET_PATH
+from .config import load_config
+from .limits import configure_limits, get_limit, get_semaphore, get_shared
+from .retry import RetryPolicy, RetryStats, backoff_delay, parse_retry_after
\ No newline at end of file
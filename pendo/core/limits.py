@@ -0,0 +1,34 @@
+from typing import Callable, Dict, Optional
+
+import asyncio
+
+"""
+Process-wide limits shared by everything that syncs concurrently, e.g. the notion request
+budget of all notion dataloaders, the embedding threads of all indexers and the llm calls
+of all summary indexers. Limits are read from the `limits` block of the config.
+"""
+
+_LIMITS = {}
+_SEMAPHORES = {}
+_SHARED = {}
+
+def configure_limits(config: Dict):
+    _LIMITS.update(config)
+
+def get_limit(name: str, default=None):
+    limit = _LIMITS.get(name, None)
+    return default if limit is None else limit
+
+def get_semaphore(name: str) -> Optional[asyncio.Semaphore]:
+    limit = get_limit(name)
+    if limit is None:
+        return None
+    if name not in _SEMAPHORES:
+        _SEMAPHORES[name] = asyncio.Semaphore(limit)
+    return _SEMAPHORES[name]
+
+def get_shared(name: str, factory: Callable):
+    # One object per limit name, e.g. a rate limiter built from the limit's params
+    if name not in _SHARED:
+        _SHARED[name] = factory(get_limit(name))
+    return _SHARED[name]
@@ -4,6 +4,8 @@ WORKSPACE_PATH = Path.home() / ".pendo"
 CONFIG_PATH = WORKSPACE_PATH / "config.yaml"
 CHROMA_PATH = WORKSPACE_PATH / "chroma"
 TIMESTAMPS_PATH = WORKSPACE_PATH / "timestamps"
+CACHE_PATH = WORKSPACE_PATH / "cache"
+SOCKET_PATH = WORKSPACE_PATH / "pendo.sock"
 
 def initialize_workspace_paths():
     if not WORKSPACE_PATH.exists():
@@ -11,4 +13,6 @@ def initialize_workspace_paths():
     if not CHROMA_PATH.exists():
         CHROMA_PATH.mkdir(parents=True, exist_ok=True)
     if not TIMESTAMPS_PATH.exists():
-        TIMESTAMPS_PATH.mkdir(parents=True, exist_ok=True)
\ No newline at end of file
+        TIMESTAMPS_PATH.mkdir(parents=True, exist_ok=True)
+    if not CACHE_PATH.exists():
+        CACHE_PATH.mkdir(parents=True, exist_ok=True)
\ No newline at end of file
@@ -0,0 +1,37 @@
+from dataclasses import dataclass
+from typing import Callable, Optional, Tuple
+
+import random
+
+"""
+Retry decisions shared by the notion and llm schedulers and the retry policies of their clients.
+"""
+
+# Given a failed request, return None if it should not be retried, otherwise
+# whether it was throttled and the server-suggested delay in seconds (if any)
+RetryPolicy = Callable[[Exception], Optional[Tuple[bool, Optional[float]]]]
+
+
+@dataclass
+class RetryStats():
+    requests: int = 0
+    throttles: int = 0
+    retries: int = 0
+    failures: int = 0
+
+    def __str__(self) -> str:
+        return f"requests={self.requests} throttles={self.throttles} retries={self.retries} failures={self.failures}"
+
+
+def backoff_delay(attempt: int, base_backoff: float, max_backoff: float, retry_after: Optional[float] = None) -> float:
+    # The server-suggested delay if there is one, otherwise full-jitter exponential backoff
+    if retry_after is not None:
+        return retry_after
+    return random.uniform(0, min(max_backoff, base_backoff * 2 ** attempt))
+
+def parse_retry_after(headers) -> Optional[float]:
+    retry_after = headers.get("retry-after", None) if headers is not None else None
+    try:
+        return float(retry_after) if retry_after is not None else None
+    except ValueError:
+        return None
@@ -0,0 +1,202 @@
+from pendo.core import SOCKET_PATH
+from pendo.llms import LlmUsage, Message, MessageDelta, MessageRole
+
+from dataclasses import asdict
+from datetime import timedelta
+from pathlib import Path
+from typing import Awaitable, Callable, Dict
+
+import asyncio
+import json
+import logging
+import os
+
+"""
+Wire format: one JSON object per line. Clients send {"query": "..."} or {"command": "sync" | "status"},
+and the daemon answers a query with {"type": "delta" | "message", ...} lines followed by {"type": "done"}.
+"""
+
+def _usage_to_dict(usage: LlmUsage) -> Dict:
+    if usage is None:
+        return None
+    usage = asdict(usage)
+    for k in ["response_time", "time_to_first_token"]:
+        if usage[k] is not None:
+            usage[k] = usage[k].total_seconds()
+    return usage
+
+def _usage_from_dict(usage: Dict) -> LlmUsage:
+    if usage is None:
+        return None
+    for k in ["response_time", "time_to_first_token"]:
+        if usage.get(k, None) is not None:
+            usage[k] = timedelta(seconds=usage[k])
+    return LlmUsage(**usage)
+
+
+class PendoDaemon():
+    """
+    Keeps the llms, indexes and embedding model warm, answers queries over a Unix socket
+    and runs `sync` in the background every `sync_interval` seconds.
+    """
+
+    def __init__(self, agent, sync: Callable[[], Awaitable[None]], sync_interval: float = 600, path: Path = SOCKET_PATH):
+        self.agent = agent
+        self.sync = sync
+        self.sync_interval = sync_interval
+        self.path = path
+        self.last_sync = None
+
+        self._sync_lock = asyncio.Lock()
+        # Syncs requested by clients, referenced until they finish so they are not collected
+        self._sync_tasks = set()
+
+    async def serve(self):
+        if self.path.exists():
+            if await is_daemon_running(self.path):
+                raise RuntimeError(f"A pendo daemon is already listening on {self.path}")
+            # Left behind by a daemon that did not shut down cleanly
+            self.path.unlink()
+
+        server = await asyncio.start_unix_server(self._handle, path=str(self.path))
+        os.chmod(self.path, 0o600)
+        sync_task = asyncio.ensure_future(self._sync_loop())
+        logging.info(f"pendo daemon listening on {self.path}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            sync_task.cancel()
+            for task in self._sync_tasks:
+                task.cancel()
+            if self.path.exists():
+                self.path.unlink()
+
+    async def _sync_loop(self):
+        while True:
+            await self._sync_once()
+            await asyncio.sleep(self.sync_interval)
+
+    async def _sync_once(self):
+        if self._sync_lock.locked():
+            # A sync is already running, and it will pick up the latest changes
+            return
+        async with self._sync_lock:
+            try:
+                await self.sync()
+                self.last_sync = asyncio.get_running_loop().time()
+            except Exception as e:
+                logging.exception(f"Background sync failed: {e}")
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        async def send(payload):
+            writer.write((json.dumps(payload) + "\n").encode("utf-8"))
+            await writer.drain()
+
+        try:
+            while True:
+                line = await reader.readline()
+                if len(line) == 0:
+                    break
+                # Every request is answered with "done", after an error frame if it failed
+                try:
+                    await self._respond(line, send)
+                except ConnectionError:
+                    raise
+                except Exception as e:
+                    logging.exception(f"Request failed: {e}")
+                    await send({"type": "error", "error": str(e)})
+                await send({"type": "done"})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, line: bytes, send: Callable[[Dict], Awaitable[None]]):
+        try:
+            request = json.loads(line)
+        except json.JSONDecodeError:
+            raise ValueError("invalid request")
+        if not isinstance(request, dict):
+            raise ValueError("invalid request")
+
+        if "query" in request:
+            async for message, usage in self.agent.run(request["query"]):
+                if isinstance(message, MessageDelta):
+                    await send({"type": "delta", "content": message.content})
+                else:
+                    await send({"type": "message", "message": asdict(message), "usage": _usage_to_dict(usage)})
+        elif request.get("command", None) == "sync":
+            task = asyncio.ensure_future(self._sync_once())
+            self._sync_tasks.add(task)
+            task.add_done_callback(self._sync_tasks.discard)
+        elif request.get("command", None) == "status":
+            await send({"type": "status", "syncing": self._sync_lock.locked(), "last_sync": self.last_sync})
+        else:
+            raise ValueError("unknown request")
+
+
+async def is_daemon_running(path: Path = SOCKET_PATH) -> bool:
+    if not path.exists():
+        return False
+    try:
+        _, writer = await asyncio.open_unix_connection(str(path))
+    except (ConnectionError, FileNotFoundError):
+        return False
+    writer.close()
+    return True
+
+
+class PendoClient():
+    """
+    Thin client of a running daemon, with the same `run` interface as the agent.
+    """
+
+    def __init__(self, path: Path = SOCKET_PATH):
+        self.path = path
+        self._reader = None
+        self._writer = None
+
+    async def _request(self, payload):
+        if self._writer is None or self._writer.is_closing():
+            # Answers can be long lines, so the buffer limit is raised from the 64KiB default
+            self._reader, self._writer = await asyncio.open_unix_connection(str(self.path), limit=16 * 1024 * 1024)
+        self._writer.write((json.dumps(payload) + "\n").encode("utf-8"))
+        await self._writer.drain()
+        done = False
+        try:
+            while True:
+                line = await self._reader.readline()
+                if len(line) == 0:
+                    raise ConnectionError("pendo daemon closed the connection")
+                response = json.loads(line)
+                if response["type"] == "done":
+                    done = True
+                    return
+                yield response
+        finally:
+            if not done:
+                # The rest of this answer would be read as the next one, so start over
+                self._writer.close()
+
+    async def run(self, query):
+        error = None
+        async for response in self._request({"query": query}):
+            if response["type"] == "delta":
+                yield MessageDelta(MessageRole.ASSISTANT, response["content"]), None
+            elif response["type"] == "message":
+                message = response["message"]
+                yield Message(MessageRole(message["role"]), message["content"], message["timestamp"]), _usage_from_dict(response["usage"])
+            elif response["type"] == "error":
+                error = response["error"]
+        if error is not None:
+            raise RuntimeError(f"pendo daemon: {error}")
+
+    async def sync(self):
+        async for response in self._request({"command": "sync"}):
+            if response["type"] == "error":
+                raise RuntimeError(f"pendo daemon: {response['error']}")
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
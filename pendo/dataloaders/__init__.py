@@ -1,4 +1,4 @@
-from .base import ChunkedDoc, BaseDataloader
+from .base import ChunkedDoc, DocRecord, BaseDataloader
 from .notion import NotionDataloader
 
 DATALOADER_MAPPER = {
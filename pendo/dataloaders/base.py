@@ -1,11 +1,13 @@
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from typing import Dict, List
-from pendo.core import TIMESTAMPS_PATH
-from asyncio import Semaphore
+from typing import Dict, List, Optional, Tuple, Union
+from pendo.core import TIMESTAMPS_PATH, get_limit, get_shared
+from .scheduler import RequestScheduler
 
 from datetime import datetime
 
+import logging
+
 @dataclass
 class ChunkedDoc():
     id: str
@@ -13,25 +15,51 @@ class ChunkedDoc():
     last_edited_time: str
     chunks: List[str]
     metadata: Dict[str, str] = None
+    chunk_tokens: List[int] = None
+
+@dataclass
+class DocRecord():
+    id: str
+    title: str
+    last_edited_time: str
+    metadata: Dict[str, str] = None
 
 class BaseDataloader(ABC):
+    limit_name = None
 
     def __init__(self, name, config, tokenizer):
         self.name = name
         self.config = config
         self.tokenizer = tokenizer
         self.max_tokens = config.get("max_tokens", 1024)
-        self.semaphore = Semaphore(20)
-        
+        # Dataloaders of a type with a global limit share one scheduler, and so its request budget.
+        # The retry policy is a staticmethod, so the shared scheduler holds no dataloader.
+        self.shared_scheduler = get_limit(self.limit_name) is not None
+        if self.shared_scheduler:
+            if config.get("rate_limit", None) is not None:
+                logging.warning(f"{name}: `rate_limit` is ignored, requests are limited by `limits.{self.limit_name}`")
+            self.scheduler = get_shared(self.limit_name, lambda rate_limit: RequestScheduler(retry_policy=type(self)._retry_policy, **rate_limit))
+        else:
+            rate_limit = config.get("rate_limit", None) or {}
+            self.scheduler = RequestScheduler(retry_policy=self._retry_policy, **rate_limit)
+
 
     @abstractmethod
-    async def retrieve_doc_ids(self, after: datetime = None) -> List[str]:
+    async def retrieve_doc_ids(self, after: datetime = None) -> List[Union[str, DocRecord]]:
         raise NotImplementedError
 
     @abstractmethod
-    async def retrieve_chunked_doc(self, doc_id: str) -> ChunkedDoc:
+    async def retrieve_chunked_doc(self, doc: Union[str, DocRecord]) -> ChunkedDoc:
         raise NotImplementedError
 
+    async def close(self):
+        # Release api clients and their connection pools
+        pass
+
+    @staticmethod
+    def _retry_policy(e: Exception) -> Optional[Tuple[bool, Optional[float]]]:
+        return None
+
     def get_timestamp(self) -> datetime:
         timestamp_file = TIMESTAMPS_PATH / f"{self.name}.txt"
         if timestamp_file.exists():
@@ -0,0 +1,172 @@
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import asyncio
+import json
+import logging
+import os
+import time
+
+
+class PageTitleCache():
+    """
+    Titles of Notion pages, kept in an in-process LRU and optionally persisted to disk.
+    An entry is dropped as soon as the page is seen with a different last_edited_time,
+    and entries older than `ttl` seconds are refetched. Only the pages of the queried
+    database are ever seen again, so a related page in another database (a tag, a project)
+    that is renamed keeps its old title until its entry is older than `ttl`.
+    """
+
+    def __init__(self, max_size: int = 4096, path: Path = None, ttl: float = 86400):
+        self.max_size = max_size
+        self.path = path
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._dirty = False
+
+        if self.path is not None and self.path.exists():
+            self._load()
+
+    def get(self, page_id: str) -> Optional[str]:
+        entry = self._entries.get(page_id, None)
+        if entry is None:
+            return None
+        if self.ttl is not None and time.time() - entry["fetched_at"] > self.ttl:
+            return None
+        self._entries.move_to_end(page_id)
+        return entry["title"]
+
+    def put(self, page_id: str, title: str, last_edited_time: str):
+        self._entries[page_id] = {"title": title, "last_edited_time": last_edited_time, "fetched_at": time.time()}
+        self._entries.move_to_end(page_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        self._dirty = True
+
+    def validate(self, page_id: str, last_edited_time: str):
+        entry = self._entries.get(page_id, None)
+        if entry is not None and entry["last_edited_time"] != last_edited_time:
+            self._entries.pop(page_id)
+            self._dirty = True
+
+    def save(self):
+        if self.path is None or not self._dirty:
+            return
+        tmp_path = self.path.with_suffix(".tmp")
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(self._entries, f)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+        except Exception as e:
+            logging.error(f"Failed to save page title cache to {self.path}: {e}")
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                entries = json.load(f)
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable page title cache at {self.path}: {e}")
+            return
+        for page_id, entry in list(entries.items())[-self.max_size:]:
+            self._entries[page_id] = entry
+
+
+class NotionResponseCache():
+    """
+    Notion page objects and flattened block trees on disk, one JSON file per page. A block
+    tree is only returned for the last_edited_time it was stored with, so changed pages are
+    fetched again while unchanged ones are read back at disk speed. Entries unused for
+    `max_age` seconds are ignored and `evict` removes them, along with the least recently
+    used pages beyond `max_pages`. Files are read and written in a worker thread.
+    """
+
+    def __init__(self, path: Path, max_pages: int = None, max_age: float = None):
+        self.path = path
+        self.max_pages = max_pages
+        self.max_age = max_age
+        self.pages_path = path / "pages"
+        self.blocks_path = path / "blocks"
+        self.pages_path.mkdir(parents=True, exist_ok=True)
+        self.blocks_path.mkdir(parents=True, exist_ok=True)
+
+    async def get_page(self, page_id: str) -> Optional[Dict]:
+        return await asyncio.to_thread(self._read, self.pages_path / f"{page_id}.json")
+
+    async def put_pages(self, pages: List[Dict]):
+        def write():
+            for page in pages:
+                self._write(self.pages_path / f"{page['id']}.json", page)
+        await asyncio.to_thread(write)
+
+    async def load_pages(self) -> List[Dict]:
+        def read():
+            pages = [self._read(page_path) for page_path in self.pages_path.glob("*.json")]
+            return [page for page in pages if page is not None]
+        return await asyncio.to_thread(read)
+
+    async def get_blocks(self, page_id: str, last_edited_time: str = None) -> Optional[List[Dict]]:
+        entry = await asyncio.to_thread(self._read, self.blocks_path / f"{page_id}.json")
+        if entry is None:
+            return None
+        if last_edited_time is not None and entry["last_edited_time"] != last_edited_time:
+            return None
+        return entry["blocks"]
+
+    async def put_blocks(self, page_id: str, last_edited_time: str, blocks: List[Dict]):
+        await asyncio.to_thread(self._write, self.blocks_path / f"{page_id}.json", {"last_edited_time": last_edited_time, "blocks": blocks})
+
+    async def evict(self):
+        await asyncio.to_thread(self._evict)
+
+    def _evict(self):
+        # A page and its block tree are kept or removed together, by the last time either was used
+        last_used = {}
+        for entry_path in list(self.pages_path.glob("*.json")) + list(self.blocks_path.glob("*.json")):
+            try:
+                last_used[entry_path.stem] = max(last_used.get(entry_path.stem, 0), entry_path.stat().st_mtime)
+            except FileNotFoundError:
+                pass
+        page_ids = sorted(last_used, key=last_used.get, reverse=True)
+
+        evicted = []
+        if self.max_age is not None:
+            now = time.time()
+            evicted = [page_id for page_id in page_ids if now - last_used[page_id] > self.max_age]
+            page_ids = page_ids[:len(page_ids) - len(evicted)]
+        if self.max_pages is not None:
+            evicted.extend(page_ids[self.max_pages:])
+
+        for page_id in evicted:
+            for entry_path in [self.pages_path / f"{page_id}.json", self.blocks_path / f"{page_id}.json"]:
+                try:
+                    entry_path.unlink()
+                except FileNotFoundError:
+                    pass
+        if len(evicted) > 0:
+            logging.info(f"Evicted {len(evicted)} pages from the notion cache at {self.path}")
+
+    def _read(self, path: Path) -> Optional[Dict]:
+        try:
+            if self.max_age is not None and time.time() - path.stat().st_mtime > self.max_age:
+                return None
+            with open(path, "r") as f:
+                value = json.load(f)
+            # The modification time doubles as the last use, for eviction
+            os.utime(path)
+            return value
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable notion cache entry at {path}: {e}")
+            return None
+
+    def _write(self, path: Path, value):
+        tmp_path = path.with_suffix(".tmp")
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(value, f)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logging.error(f"Failed to write notion cache entry at {path}: {e}")
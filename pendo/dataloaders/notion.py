@@ -1,7 +1,8 @@
-from .base import BaseDataloader, ChunkedDoc
+from .base import BaseDataloader, ChunkedDoc, DocRecord
+from .cache import NotionResponseCache, PageTitleCache
+from pendo.core import CACHE_PATH, parse_retry_after
 
-from notion_client import AsyncClient, Client
-from typing import Dict, List
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Union
 from datetime import datetime
 
 import logging
@@ -55,43 +56,50 @@ BLOCKS_BREAK = [
     "table_of_contents"
 ]
 
+# Blocks whose children belong to another page, or are all ignored (the rows of a table),
+# and must not be walked
+BLOCKS_NO_DESCEND = [
+    "child_database",
+    "child_page",
+    "table",
+]
+
+
+def _parse_page_title(page: Dict) -> str:
+    for prop in page["properties"].values():
+        if prop["type"] == "title":
+            return " ".join([sec.get("plain_text", "") for sec in prop.get("title", [])])
+    return ""
+
 
-def _parse_relation_prop(prop: Dict, client: Client) -> str:
+def _parse_relation_prop(prop: Dict, titles: Dict[str, str]) -> str:
     target_ids = [sec["id"] for sec in prop.get("relation", [])]
-    results = []
-    related_pages = [client.pages.retrieve(page_id = id) for id in target_ids]
-    for page in related_pages:
-        for prop in page["properties"].values():
-            if prop["type"] == "title":
-                results.append(" ".join([sec.get("plain_text", "") for sec in prop.get("title", [])]))
-    return ";".join(results)
+    return ";".join([titles[id] for id in target_ids if titles.get(id, None) is not None])
 
 
+# Parsers take the property and the titles of the pages it relates to, resolved beforehand
 PROP_PRASER_MAPPER = {
-    "title": lambda prop, client: " ".join([sec.get("plain_text", "") for sec in prop.get("title", [])]),
+    "title": lambda prop, titles: " ".join([sec.get("plain_text", "") for sec in prop.get("title", [])]),
     "relation": _parse_relation_prop,
-    "last_edited_time": lambda prop, client: prop.get("last_edited_time", ""),
-    "date": lambda prop, client: prop.get("date", {}).get("start", ""),
-    "rich_text": lambda prop, client: " ".join([sec.get("plain_text", "") for sec in prop.get("rich_text", [])]),
+    "last_edited_time": lambda prop, titles: prop.get("last_edited_time", ""),
+    "date": lambda prop, titles: prop.get("date", {}).get("start", ""),
+    "rich_text": lambda prop, titles: " ".join([sec.get("plain_text", "") for sec in prop.get("rich_text", [])]),
 }
 
 
 class NotionDataloader(BaseDataloader):
+    limit_name = "notion"
 
     def __init__(self, name, config, tokenizer):
         super().__init__(name, config, tokenizer)
 
         notion_token = config.get("notion_token", None)
+        from notion_client import AsyncClient
         try:
             self.notion_client = AsyncClient(auth=notion_token)
         except Exception as e:
             logging.error(f"Unable to initiate Notion client: {e}")
             raise e
-        try:
-            self.sync_notion_client = Client(auth=notion_token)
-        except Exception as e:
-            logging.error(f"Unable to initiate Notion client: {e}")
-            raise e
 
         self.db_id = config.get("database_id", None)
         self.title_prop = config.get("title_prop", None)
@@ -103,20 +111,84 @@ class NotionDataloader(BaseDataloader):
         for mt in config.get("metadata", {}):
             self.metadata_map[mt["key"]] = mt
 
+        # Build documents from the page objects returned by databases.query
+        # instead of retrieving every page again
+        self.reuse_query_results = config.get("reuse_query_results", False)
+        self._filter_properties = None
+
+        # Titles of related pages, shared by all documents of a sync run
+        self.title_cache = PageTitleCache(
+            max_size=config.get("relation_cache_size", 4096),
+            path=CACHE_PATH / f"{name}_titles.json" if config.get("relation_cache_on_disk", True) else None,
+            ttl=config.get("relation_cache_ttl", 86400),
+        )
+        self._title_requests = {}
+
+        # Pages and block trees seen before, and offline replay of them without any api call.
+        # Nothing is evicted offline, as the cache is all there is.
+        self.offline = config.get("offline", False)
+        self.response_cache = None
+        if config.get("response_cache", True) or self.offline:
+            max_age_days = config.get("response_cache_max_age_days", 30)
+            self.response_cache = NotionResponseCache(
+                CACHE_PATH / "notion" / self.db_id,
+                max_pages=config.get("response_cache_max_pages", 10000) if not self.offline else None,
+                max_age=max_age_days * 86400 if max_age_days is not None and not self.offline else None,
+            )
+
 
 
     """
-    Retrieve all page_ids from the target Notion database
+    Retrieve all page_ids from the target Notion database, or the page records
+    themselves if `reuse_query_results` is enabled
     """
-    async def retrieve_doc_ids(self, after: datetime = None) -> List[str]:
+    async def retrieve_doc_ids(self, after: datetime = None) -> List[Union[str, DocRecord]]:
+        if self.offline:
+            return await self._retrieve_cached_doc_records()
+        if self.reuse_query_results:
+            return [record async for record in self.iter_doc_records(after)]
+
         doc_ids = []
+        async for pages in self._query_pages(after):
+            doc_ids.extend([page["id"] for page in pages])
+        return doc_ids
+
+    """
+    Yield lightweight page records straight from the database query stream
+    """
+    async def iter_doc_records(self, after: datetime = None) -> AsyncIterator[DocRecord]:
+        if self._filter_properties is None:
+            self._filter_properties = await self._get_filter_properties()
+
+        async for pages in self._query_pages(after, filter_properties=self._filter_properties):
+            # Resolve the relations of a whole result page at once
+            titles = await self._resolve_relations(pages)
+            for page in pages:
+                yield self._parse_page(page, titles)
+        self.title_cache.save()
+
+    """
+    Records of every cached page whose block tree is cached as well, regardless of the timestamp,
+    so that all indexes can be rebuilt offline
+    """
+    async def _retrieve_cached_doc_records(self) -> List[DocRecord]:
+        records = []
+        for page in await self.response_cache.load_pages():
+            titles = await self._resolve_relations([page])
+            record = self._parse_page(page, titles)
+            if await self.response_cache.get_blocks(record.id, record.last_edited_time) is not None:
+                records.append(record)
+        return records
+
+    async def _query_pages(self, after: datetime = None, **kwargs) -> AsyncIterator[List[Dict]]:
         start_cursor = None
 
         if after is None:
             after = self.get_timestamp()
 
         while True:
-            response = await self.notion_client.databases.query(
+            response = await self.scheduler.run(
+                self.notion_client.databases.query,
                 database_id=self.db_id,
                 start_cursor=start_cursor,
                 page_size=100,  # this is the maximum page size allowed by the Notion API
@@ -125,54 +197,212 @@ class NotionDataloader(BaseDataloader):
                     "date": {
                         "after": after.isoformat() if after is not None else None
                     }
-                }
+                },
+                **kwargs
             )
-            doc_ids.extend([doc["id"] for doc in response["results"]])
+            for page in response["results"]:
+                self.title_cache.validate(page["id"], page["last_edited_time"])
+            if self.response_cache is not None:
+                await self.response_cache.put_pages(response["results"])
+            yield response["results"]
 
             if "next_cursor" in response and response["next_cursor"] is not None:
                 start_cursor = response["next_cursor"]
             else:
                 break
 
-        return doc_ids
-
-    async def retrieve_chunked_doc(self, doc_id: str) -> ChunkedDoc:
-        async with self.semaphore:
-            page = await self.notion_client.pages.retrieve(page_id=doc_id)
+    async def _get_filter_properties(self) -> List[str]:
+        # filter_properties takes property ids, so look them up from the database schema
+        database = await self.scheduler.run(self.notion_client.databases.retrieve, database_id=self.db_id)
+        names = [self.title_prop, self.last_edited_prop] + [mt["property_name"] for mt in self.metadata_map.values()]
+        return [database["properties"][name]["id"] for name in names if name in database["properties"]]
 
+    def _parse_page(self, page: Dict, titles: Dict[str, str]) -> DocRecord:
         properties = page["properties"]
-        title = self._parse_prop(properties.get(self.title_prop, {}))
-        last_edited = self._parse_prop(properties.get(self.last_edited_prop, {}))
+        title = self._parse_prop(properties.get(self.title_prop, {}), titles)
+        last_edited = self._parse_prop(properties.get(self.last_edited_prop, {}), titles)
 
         metadata = {}
         for mt in self.metadata_map.values():
-            parsed_prop = self._parse_prop(properties.get(mt["property_name"], {}))
+            parsed_prop = self._parse_prop(properties.get(mt["property_name"], {}), titles)
             if parsed_prop is not None:
                 metadata[mt["key"]] = parsed_prop
 
-        blocks = await self.notion_client.blocks.children.list(block_id = doc_id)
+        return DocRecord(
+            id=page["id"],
+            title=title,
+            last_edited_time=last_edited,
+            metadata=metadata
+        )
 
-        chunks = self._chunk_blocks(blocks["results"], self.max_tokens)
+    async def retrieve_chunked_doc(self, doc: Union[str, DocRecord]) -> ChunkedDoc:
+        if isinstance(doc, str):
+            page = await self.scheduler.run(self.notion_client.pages.retrieve, page_id=doc)
+            if self.response_cache is not None:
+                await self.response_cache.put_pages([page])
+            titles = await self._resolve_relations([page])
+            doc = self._parse_page(page, titles)
+
+        blocks = None
+        if self.response_cache is not None:
+            blocks = await self.response_cache.get_blocks(doc.id, doc.last_edited_time)
+        if blocks is None:
+            if self.offline:
+                raise ValueError(f"Block tree of page {doc.id} is not cached, unable to load it offline")
+            blocks = list(await self._retrieve_block_tree(doc.id))
+            # Without an edit time the cached tree could never be validated
+            if self.response_cache is not None and doc.last_edited_time:
+                await self.response_cache.put_blocks(doc.id, doc.last_edited_time, blocks)
+
+        chunks, chunk_tokens = self._chunk_blocks(blocks, self.max_tokens)
 
         return ChunkedDoc(
-            id=doc_id,
-            title=title,
-            last_edited_time=last_edited,
+            id=doc.id,
+            title=doc.title,
+            last_edited_time=doc.last_edited_time,
             chunks=chunks,
-            metadata=metadata
+            metadata=doc.metadata,
+            chunk_tokens=chunk_tokens
         )
 
-    def _parse_prop(self, prop):
+    async def _list_block_children(self, block_id: str) -> List[Dict]:
+        children = []
+        start_cursor = None
+        while True:
+            response = await self.scheduler.run(
+                self.notion_client.blocks.children.list,
+                block_id=block_id,
+                start_cursor=start_cursor,
+                page_size=100,  # this is the maximum page size allowed by the Notion API
+            )
+            children.extend(response["results"])
+
+            if response.get("has_more") and response.get("next_cursor") is not None:
+                start_cursor = response["next_cursor"]
+            else:
+                break
+        return children
+
+    """
+    Walk the block tree of a page breadth-first, fetching every level concurrently,
+    and return an iterator over all blocks in document order
+    """
+    async def _retrieve_block_tree(self, doc_id: str):
+        children = {}
+        level = [(doc_id, doc_id)]
+        while len(level) > 0:
+            results = await asyncio.gather(*(self._list_block_children(source_id) for _, source_id in level))
+
+            next_level = []
+            for (block_id, _), blocks in zip(level, results):
+                children[block_id] = blocks
+                for block in blocks:
+                    if block["type"] in BLOCKS_NO_DESCEND:
+                        continue
+                    source_id = self._children_source(block)
+                    if not block.get("has_children", False) and source_id == block["id"]:
+                        continue
+                    next_level.append((block["id"], source_id))
+            level = next_level
+
+        return self._iter_blocks(children, doc_id)
+
+    def _children_source(self, block: Dict) -> str:
+        # Duplicated synced blocks keep their content under the original block
+        if block["type"] == "synced_block":
+            synced_from = block.get("synced_block", {}).get("synced_from")
+            if synced_from is not None and synced_from.get("block_id") is not None:
+                return synced_from["block_id"]
+        return block["id"]
+
+    def _iter_blocks(self, children: Dict[str, List[Dict]], block_id: str):
+        for block in children.get(block_id, []):
+            yield block
+            yield from self._iter_blocks(children, block["id"])
+
+    """
+    Resolve the titles of all pages related to the given pages, from the title cache
+    where possible. Concurrent lookups of the same page share one request. Cached titles
+    of related pages outside this database expire by `relation_cache_ttl` only.
+    """
+    async def _resolve_relations(self, pages: List[Dict]) -> Dict[str, str]:
+        prop_names = [self.title_prop, self.last_edited_prop] + [mt["property_name"] for mt in self.metadata_map.values()]
+        page_ids = set()
+        for page in pages:
+            for name in prop_names:
+                prop = page["properties"].get(name, {})
+                if prop.get("type", "") == "relation":
+                    page_ids.update([sec["id"] for sec in prop.get("relation", None) or []])
+
+        titles = {}
+        missing = []
+        for page_id in page_ids:
+            title = self.title_cache.get(page_id)
+            if title is None:
+                missing.append(page_id)
+            else:
+                titles[page_id] = title
+
+        fetched = await asyncio.gather(*(self._retrieve_page_title(page_id) for page_id in missing))
+        titles.update(zip(missing, fetched))
+        return titles
+
+    async def _retrieve_page_title(self, page_id: str) -> str:
+        if page_id not in self._title_requests:
+            self._title_requests[page_id] = asyncio.ensure_future(self._fetch_page_title(page_id))
+            self._title_requests[page_id].add_done_callback(lambda _: self._title_requests.pop(page_id, None))
+        return await self._title_requests[page_id]
+
+    async def _fetch_page_title(self, page_id: str) -> str:
+        if self.offline:
+            page = await self.response_cache.get_page(page_id)
+            return _parse_page_title(page) if page is not None else None
+        page = await self.scheduler.run(self.notion_client.pages.retrieve, page_id=page_id)
+        if self.response_cache is not None:
+            await self.response_cache.put_pages([page])
+        title = _parse_page_title(page)
+        self.title_cache.put(page_id, title, page["last_edited_time"])
+        return title
+
+    async def close(self):
+        if self.response_cache is not None:
+            await self.response_cache.evict()
+        await self.notion_client.aclose()
+
+    @staticmethod
+    def _retry_policy(e: Exception) -> Optional[Tuple[bool, Optional[float]]]:
+        # Only APIResponseError is exported at the top level of notion_client, the rest live in errors
+        from notion_client.errors import HTTPResponseError, RequestTimeoutError
+        import httpx
+        # APIResponseError (a 4xx/5xx with a notion error code) is a subclass of HTTPResponseError
+        if isinstance(e, HTTPResponseError):
+            if e.status == 429:
+                return True, parse_retry_after(e.headers)
+            if e.status in (500, 502, 503, 504):
+                return False, None
+            return None
+        if isinstance(e, (RequestTimeoutError, httpx.TransportError)):
+            return False, None
+        return None
+
+    def save_timestamp(self, timestamp: datetime):
+        # An offline replay has not seen any change made since the last online sync
+        if not self.offline:
+            super().save_timestamp(timestamp)
+        self.title_cache.save()
+
+    def _parse_prop(self, prop, titles):
         prop_type = prop.get("type", "")
         if prop_type not in PROP_PRASER_MAPPER:
             return None
         if prop[prop_type] is None:
             return None
-        return PROP_PRASER_MAPPER[prop_type](prop, self.sync_notion_client)
+        return PROP_PRASER_MAPPER[prop_type](prop, titles)
 
 
     def _chunk_blocks(self, blocks, max_tokens):
         chunks = []
+        chunk_tokens = []
         current_chunk = []
         current_size = 0
         last_item_size = 0
@@ -197,6 +427,7 @@ class NotionDataloader(BaseDataloader):
             nonlocal current_chunk, current_size, chunks, last_item_size
             if len(current_chunk) > 0:
                 chunks.append("\n".join(current_chunk))
+                chunk_tokens.append(current_size)
             current_chunk = []
             current_size = 0
             last_item_size = 0
@@ -205,6 +436,7 @@ class NotionDataloader(BaseDataloader):
             nonlocal current_chunk, current_size, chunks, last_item_size
             if len(current_chunk) > 2:
                 chunks.append("\n".join(current_chunk[:-1]))
+                chunk_tokens.append(current_size - last_item_size)
                 current_chunk = [current_chunk[-1]]
                 current_size = last_item_size
 
@@ -284,4 +516,4 @@ class NotionDataloader(BaseDataloader):
         if len(current_chunk) > 0:
             reset_chunk()
 
-        return chunks
\ No newline at end of file
+        return chunks, chunk_tokens
\ No newline at end of file
@@ -0,0 +1,150 @@
+from dataclasses import dataclass
+from typing import Optional
+from pendo.core import RetryPolicy, RetryStats, backoff_delay
+
+import asyncio
+import logging
+import time
+
+
+@dataclass
+class SchedulerStats(RetryStats):
+    total_latency: float = 0.0
+
+    @property
+    def average_latency(self):
+        return self.total_latency / self.requests if self.requests > 0 else 0.0
+
+    def __str__(self) -> str:
+        return f"{super().__str__()} avg_latency={self.average_latency:.2f}s"
+
+
+class RequestScheduler():
+    """
+    Admits API requests through a token bucket of `requests_per_second` (with `burst` capacity)
+    and an adaptive concurrency limit, and retries failed requests with jittered exponential
+    backoff or the delay requested by the server. The concurrency limit grows additively while
+    requests complete under `target_latency`, shrinks by one on a slow request or a retried
+    error (a 5xx or a timeout) and is halved on every throttle.
+    """
+
+    def __init__(
+        self,
+        requests_per_second: float = 3.0,
+        burst: int = 3,
+        max_concurrency: int = 20,
+        min_concurrency: int = 1,
+        target_latency: float = 2.0,
+        max_retries: int = 5,
+        base_backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        retry_policy: RetryPolicy = None,
+    ):
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.retry_policy = retry_policy if retry_policy is not None else lambda e: None
+
+        self.concurrency = max(min_concurrency, min(max_concurrency, burst))
+        self.stats = SchedulerStats()
+
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._blocked_until = 0.0
+        self._active = 0
+        self._completed = 0
+        self._bucket_lock = asyncio.Lock()
+        self._slots = asyncio.Condition()
+
+    async def run(self, request, *args, **kwargs):
+        attempt = 0
+        while True:
+            await self._acquire()
+            start_time = time.monotonic()
+            try:
+                result = await request(*args, **kwargs)
+            except Exception as e:
+                await self._release()
+                self.stats.requests += 1
+                self.stats.total_latency += time.monotonic() - start_time
+
+                decision = self.retry_policy(e)
+                if decision is None or attempt >= self.max_retries:
+                    self.stats.failures += 1
+                    raise e
+                throttled, retry_after = decision
+                delay = self._backoff(attempt, retry_after)
+                if throttled:
+                    self._on_throttle(delay)
+                else:
+                    self._on_error()
+                attempt += 1
+                self.stats.retries += 1
+                logging.debug(f"Retrying request in {delay:.2f}s (attempt {attempt}/{self.max_retries}): {e}")
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                await self._release()
+                raise
+
+            latency = time.monotonic() - start_time
+            await self._release()
+            self.stats.requests += 1
+            self.stats.total_latency += latency
+            self._on_success(latency)
+            return result
+
+    def _backoff(self, attempt: int, retry_after: Optional[float]) -> float:
+        return backoff_delay(attempt, self.base_backoff, self.max_backoff, retry_after)
+
+    def _on_throttle(self, delay: float):
+        self.stats.throttles += 1
+        self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+        self.concurrency = max(self.min_concurrency, self.concurrency // 2)
+        self._completed = 0
+
+    def _on_error(self):
+        self.concurrency = max(self.min_concurrency, self.concurrency - 1)
+        self._completed = 0
+
+    def _on_success(self, latency: float):
+        if latency > self.target_latency:
+            self.concurrency = max(self.min_concurrency, self.concurrency - 1)
+            self._completed = 0
+            return
+        self._completed += 1
+        if self._completed >= self.concurrency and self.concurrency < self.max_concurrency:
+            self.concurrency += 1
+            self._completed = 0
+
+    async def _acquire(self):
+        async with self._slots:
+            await self._slots.wait_for(lambda: self._active < self.concurrency)
+            self._active += 1
+
+        try:
+            async with self._bucket_lock:
+                while True:
+                    now = time.monotonic()
+                    if now < self._blocked_until:
+                        await asyncio.sleep(self._blocked_until - now)
+                        continue
+                    self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.requests_per_second)
+                    self._refilled_at = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    await asyncio.sleep((1 - self._tokens) / self.requests_per_second)
+        except BaseException:
+            await self._release()
+            raise
+
+    async def _release(self):
+        async with self._slots:
+            self._active -= 1
+            self._slots.notify_all()
@@ -1,10 +1,14 @@
 from .chunk import ChunkIndexer
 from .summary import SummaryIndexer
+from .centroid import CentroidIndexer
 from .base import BaseIndexer
+from .embeddings import CachedEmbeddingFunction
+from .registry import configure_embeddings, get_chroma_client, get_embedding_executor, get_embedding_function
 
 INDEXER_MAPPER = {
     "summary": SummaryIndexer,
     "chunk": ChunkIndexer,
+    "centroid": CentroidIndexer,
 }
 
 REGISTERED_INDEXERS = {}
@@ -1,15 +1,28 @@
 from abc import ABC, abstractmethod
-from pendo.core import CHROMA_PATH
 from pendo.dataloaders import ChunkedDoc
 from typing import List
-import chromadb
+from .registry import get_chroma_client, get_embedding_function
 
 class BaseIndexer(ABC):
     def __init__(self, name, **kwargs):
         self.name = name
-        self.chroma_client = chromadb.PersistentClient(path=str(CHROMA_PATH))
+        self.stats = None
+        self._index = None
 
-        self.index = self.chroma_client.get_or_create_collection(name=self.name, embedding_function=chromadb.utils.embedding_functions.DefaultEmbeddingFunction())
+    @property
+    def chroma_client(self):
+        return get_chroma_client()
+
+    @property
+    def embedding_function(self):
+        return get_embedding_function()
+
+    @property
+    def index(self):
+        # Opened on first use, so registering an indexer is free until it is used
+        if self._index is None:
+            self._index = self.chroma_client.get_or_create_collection(name=self.name, embedding_function=self.embedding_function)
+        return self._index
 
     @abstractmethod
     async def index_docs(docs: List[ChunkedDoc]):
@@ -0,0 +1,98 @@
+from .base import BaseIndexer
+from .chunk import _content_hash
+from .registry import get_embedding_executor
+from pendo.dataloaders import ChunkedDoc
+
+from functools import partial
+from typing import List
+
+import asyncio
+import numpy as np
+
+class CentroidIndexer(BaseIndexer):
+    """
+    Indexes every doc as the normalized centroid of its chunk embeddings, weighted by chunk
+    tokens. Chunk embeddings are read from the `chunk_index_name` collection of a ChunkIndexer
+    when it holds the same content, and the rest are embedded through the shared cached
+    embedding function, which also shares the work of a ChunkIndexer embedding them right now.
+    """
+
+    def __init__(self, name, weighted=True, chunk_index_name="chunk", **kwargs):
+        super().__init__(name, **kwargs)
+        self.weighted = weighted
+        self.chunk_index_name = chunk_index_name
+        self._chunk_index = None
+
+    @property
+    def chunk_index(self):
+        if self._chunk_index is None and self.chunk_index_name is not None:
+            self._chunk_index = self.chroma_client.get_or_create_collection(name=self.chunk_index_name, embedding_function=self.embedding_function)
+        return self._chunk_index
+
+    async def index_docs(self, docs: List[ChunkedDoc]):
+        loop = asyncio.get_running_loop()
+
+        empty_ids = [doc.id for doc in docs if len(doc.chunks) == 0]
+        if len(empty_ids) > 0:
+            await loop.run_in_executor(None, partial(self.index.delete, ids=empty_ids))
+        docs = [doc for doc in docs if len(doc.chunks) > 0]
+        if len(docs) == 0:
+            return
+
+        embeddings = await self._chunk_embeddings(docs)
+
+        weights = []
+        for doc in docs:
+            if self.weighted and doc.chunk_tokens is not None:
+                weights.append(np.maximum(np.asarray(doc.chunk_tokens, dtype=np.float32), 1.0))
+            else:
+                weights.append(np.ones(len(doc.chunks), dtype=np.float32))
+        weights = np.concatenate(weights)
+
+        # Weighted sum of each doc's contiguous run of chunk embeddings, then unit length
+        offsets = np.cumsum([0] + [len(doc.chunks) for doc in docs[:-1]])
+        centroids = np.add.reduceat(embeddings * weights[:, None], offsets, axis=0)
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        centroids = centroids / np.where(norms > 0, norms, 1.0)
+
+        metadatas = []
+        for doc in docs:
+            metadata = {"title": doc.title, "last_edited_time": doc.last_edited_time, "num_chunks": len(doc.chunks)}
+            for k, v in doc.metadata.items():
+                if v is None:
+                    continue
+                metadata[k] = v
+            metadatas.append(metadata)
+
+        await loop.run_in_executor(None, partial(
+            self.index.upsert,
+            ids = [doc.id for doc in docs],
+            embeddings = centroids.tolist(),
+            metadatas = metadatas,
+            documents = [doc.title for doc in docs],
+        ))
+
+    async def _chunk_embeddings(self, docs: List[ChunkedDoc]) -> np.ndarray:
+        loop = asyncio.get_running_loop()
+        keys = [(doc.id, _content_hash(chunk)) for doc in docs for chunk in doc.chunks]
+        chunks = [chunk for doc in docs for chunk in doc.chunks]
+
+        stored = {}
+        if self.chunk_index is not None:
+            existing = await loop.run_in_executor(None, partial(
+                self.chunk_index.get,
+                where = {"doc_id": {"$in": [doc.id for doc in docs]}},
+                include = ["metadatas", "embeddings"],
+            ))
+            for metadata, embedding in zip(existing["metadatas"], existing["embeddings"]):
+                if metadata.get("content_hash", None) is not None:
+                    stored[(metadata["doc_id"], metadata["content_hash"])] = embedding
+
+        missing = [i for i, key in enumerate(keys) if key not in stored]
+        computed = []
+        if len(missing) > 0:
+            computed = await loop.run_in_executor(get_embedding_executor(), self.embedding_function, [chunks[i] for i in missing])
+        embeddings = [stored.get(key, None) for key in keys]
+        for i, embedding in zip(missing, computed):
+            embeddings[i] = embedding
+        return np.asarray(embeddings, dtype=np.float32)
@@ -1,34 +1,139 @@
 from .base import BaseIndexer
+from .registry import get_embedding_executor
 from pendo.dataloaders import ChunkedDoc
 
+from asyncio import Semaphore
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
 from typing import List
 
+import asyncio
+import hashlib
+import logging
+import os
+import time
+
+@dataclass
+class EmbeddingStats():
+    embeddings: int = 0
+    skipped: int = 0
+    deleted: int = 0
+    seconds: float = 0.0
+
+    @property
+    def embeddings_per_second(self):
+        return self.embeddings / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self) -> str:
+        return f"embeddings computed={self.embeddings} ({self.embeddings_per_second:.1f}/s) skipped={self.skipped} stale chunks deleted={self.deleted}"
+
+def _content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
 class ChunkIndexer(BaseIndexer):
 
-    def __init__(self, name, **kwargs):
+    def __init__(self, name, batch_size=256, embedding_workers=None, **kwargs):
         super().__init__(name, **kwargs)
+        self.batch_size = batch_size
+        self.embedding_workers = embedding_workers or os.cpu_count() or 1
+        self.stats = EmbeddingStats()
+
+        # The embedding model releases the GIL, so batches are embedded on the shared thread pool
+        # while a single writer thread upserts finished batches in order of completion
+        self.embedding_executor = get_embedding_executor()
+        self.upsert_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{name}-upsert")
 
     async def index_docs(self, docs: List[ChunkedDoc]):
+        if len(docs) == 0:
+            return
+        loop = asyncio.get_running_loop()
+
+        # Embeddings already stored for these docs, keyed by content hash
+        existing = await loop.run_in_executor(self.upsert_executor, partial(
+            self.index.get,
+            where = {"doc_id": {"$in": [doc.id for doc in docs]}},
+            include = ["metadatas", "embeddings"],
+        ))
+        existing_embeddings = {}
+        stale_ids = set(existing["ids"])
+        for metadata, embedding in zip(existing["metadatas"], existing["embeddings"]):
+            if metadata.get("content_hash", None) is not None:
+                existing_embeddings[(metadata["doc_id"], metadata["content_hash"])] = embedding
+
         ids = []
         metadatas = []
         documents = []
+        reused_ids = []
+        reused_metadatas = []
+        reused_documents = []
+        reused_embeddings = []
         for doc in docs:
             for i, chunk in enumerate(doc.chunks):
-                ids.append(f"{doc.id}_{i+1}")
+                chunk_id = f"{doc.id}_{i+1}"
+                content_hash = _content_hash(chunk)
                 metadata = {
                     "title": doc.title,
                     "last_edited_time": doc.last_edited_time,
                     "doc_id": doc.id,
                     "chunk_id": i+1,
+                    "content_hash": content_hash,
                 }
+                if doc.chunk_tokens is not None:
+                    metadata["num_tokens"] = doc.chunk_tokens[i]
                 for k, v in doc.metadata.items():
                     if v is None:
                         continue
                     metadata[k] = v
+                stale_ids.discard(chunk_id)
+
+                # Unchanged (or moved) chunks keep their embedding
+                embedding = existing_embeddings.get((doc.id, content_hash), None)
+                if embedding is not None:
+                    reused_ids.append(chunk_id)
+                    reused_metadatas.append(metadata)
+                    reused_documents.append(chunk)
+                    reused_embeddings.append(embedding)
+                    continue
+                ids.append(chunk_id)
                 metadatas.append(metadata)
                 documents.append(chunk)
-        self.index.upsert(
-            ids = ids, 
-            metadatas= metadatas,
-            documents= documents
-        )
\ No newline at end of file
+
+        if len(reused_ids) > 0:
+            await loop.run_in_executor(self.upsert_executor, partial(
+                self.index.upsert,
+                ids = reused_ids,
+                embeddings = reused_embeddings,
+                metadatas = reused_metadatas,
+                documents = reused_documents,
+            ))
+        if len(stale_ids) > 0:
+            await loop.run_in_executor(self.upsert_executor, partial(self.index.delete, ids=list(stale_ids)))
+
+        start_time = time.monotonic()
+        await self._embed_and_upsert(ids, metadatas, documents)
+        elapsed = time.monotonic() - start_time
+
+        self.stats.embeddings += len(documents)
+        self.stats.skipped += len(reused_ids)
+        self.stats.deleted += len(stale_ids)
+        self.stats.seconds += elapsed
+        logging.info(f"{self.name}: embedded {len(documents)} chunks in {elapsed:.2f}s, reused {len(reused_ids)}, deleted {len(stale_ids)} stale chunks")
+
+    async def _embed_and_upsert(self, ids, metadatas, documents):
+        loop = asyncio.get_running_loop()
+        semaphore = Semaphore(self.embedding_workers)
+
+        async def process_batch(start):
+            end = start + self.batch_size
+            async with semaphore:
+                embeddings = await loop.run_in_executor(self.embedding_executor, self.embedding_function, documents[start:end])
+            await loop.run_in_executor(self.upsert_executor, partial(
+                self.index.upsert,
+                ids = ids[start:end],
+                embeddings = embeddings,
+                metadatas = metadatas[start:end],
+                documents = documents[start:end],
+            ))
+
+        await asyncio.gather(*(process_batch(start) for start in range(0, len(documents), self.batch_size)))
\ No newline at end of file
@@ -0,0 +1,135 @@
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Dict, List
+
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+
+
+class CachedEmbeddingFunction():
+    """
+    Wraps an embedding function with an in-memory LRU in front of a SQLite store of
+    float32 vectors, keyed by model name and text hash. Both keep vectors as float32 arrays
+    (a quarter the size of a list of floats) and the store is trimmed to `max_disk_bytes`
+    by evicting the least recently used vectors. Texts being embedded by another caller
+    are waited for rather than embedded twice.
+    """
+
+    def __init__(self, embedding_function, model_name: str, path: Path = None, memory_items: int = 10000, max_disk_bytes: int = 512 * 1024 * 1024):
+        self.embedding_function = embedding_function
+        self.model_name = model_name
+        self.memory_items = memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self._memory: "OrderedDict[str, array]" = OrderedDict()
+        self._pending: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._db = None
+        self._disk_bytes = 0
+        if path is not None:
+            try:
+                self._db = sqlite3.connect(str(path), check_same_thread=False)
+                self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB, last_used REAL)")
+                self._db.commit()
+                self._disk_bytes = self._db.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+            except sqlite3.Error as e:
+                logging.warning(f"Embedding cache at {path} is unavailable, caching in memory only: {e}")
+                self._db = None
+
+    def __call__(self, input: List[str]) -> List[List[float]]:
+        keys = [self._key(text) for text in input]
+        found: Dict[str, array] = {}
+
+        with self._lock:
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+            if self._db is not None:
+                found.update(self._load([key for key in set(keys) if key not in found]))
+
+            missing = {}
+            waiting = {}
+            for key, text in zip(keys, input):
+                if key in found or key in missing or key in waiting:
+                    continue
+                if key in self._pending:
+                    waiting[key] = self._pending[key]
+                else:
+                    missing[key] = text
+            for key in missing:
+                self._pending[key] = Future()
+            self.hits += len([key for key in keys if key not in missing])
+            self.misses += len(missing)
+
+        # Our own texts are embedded before waiting on others, so two callers never wait on each other
+        if len(missing) > 0:
+            try:
+                embeddings = self.embedding_function(list(missing.values()))
+            except BaseException as e:
+                with self._lock:
+                    for key in missing:
+                        self._pending.pop(key).set_exception(e)
+                raise
+            # Round through float32 so fresh and cached embeddings are identical
+            computed = {key: array("f", embedding) for key, embedding in zip(missing.keys(), embeddings)}
+            found.update(computed)
+            with self._lock:
+                for key, embedding in computed.items():
+                    self._remember(key, embedding)
+                    self._pending.pop(key).set_result(embedding)
+                if self._db is not None:
+                    self._store(computed)
+        for key, future in waiting.items():
+            found[key] = future.result()
+
+        return [found[key].tolist() for key in keys]
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, embedding: array):
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def _load(self, keys: List[str]) -> Dict[str, array]:
+        found = {}
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start+500]
+            placeholders = ",".join("?" * len(batch))
+            rows = self._db.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch).fetchall()
+            for key, blob in rows:
+                vector = array("f")
+                vector.frombytes(blob)
+                found[key] = vector
+                self._remember(key, vector)
+            if len(rows) > 0:
+                self._db.execute(f"UPDATE embeddings SET last_used = ? WHERE key IN ({placeholders})", [time.time()] + batch)
+        self._db.commit()
+        return found
+
+    def _store(self, embeddings: Dict[str, array]):
+        now = time.time()
+        rows = [(key, embedding.tobytes(), now) for key, embedding in embeddings.items()]
+        self._db.executemany("INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)", rows)
+        self._disk_bytes += sum(len(row[1]) for row in rows)
+
+        if self._disk_bytes > self.max_disk_bytes:
+            # Evict the least recently used tenth below the limit in one statement
+            row_bytes = len(rows[0][1])
+            excess = self._disk_bytes - int(self.max_disk_bytes * 0.9)
+            self._db.execute(
+                "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                (excess // row_bytes + 1,),
+            )
+            self._disk_bytes = self._db.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+        self._db.commit()
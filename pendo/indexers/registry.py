@@ -0,0 +1,63 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from pendo.core import CACHE_PATH, CHROMA_PATH, get_limit
+from .embeddings import CachedEmbeddingFunction
+
+import os
+import threading
+
+"""
+Process-wide chroma clients, embedding functions and embedding thread pool, one per path
+and one per model, created on first use so commands that never touch an index never load chromadb or the model.
+"""
+
+def _default_embedding_function():
+    from chromadb.utils.embedding_functions import DefaultEmbeddingFunction
+    return DefaultEmbeddingFunction()
+
+EMBEDDING_MAPPER = {
+    "default": _default_embedding_function,
+}
+
+_EMBEDDING_CONFIG = {}
+_EMBEDDING_FUNCTIONS = {}
+_CHROMA_CLIENTS = {}
+_EMBEDDING_EXECUTOR = None
+_LOCK = threading.Lock()
+
+def configure_embeddings(config):
+    _EMBEDDING_CONFIG.update(config)
+
+def get_chroma_client(path: Path = CHROMA_PATH):
+    path = str(path)
+    with _LOCK:
+        if path not in _CHROMA_CLIENTS:
+            import chromadb
+            _CHROMA_CLIENTS[path] = chromadb.PersistentClient(path=path)
+        return _CHROMA_CLIENTS[path]
+
+def get_embedding_executor() -> ThreadPoolExecutor:
+    # Every indexer embeds on the same pool, bounded by the global embedding_workers limit
+    global _EMBEDDING_EXECUTOR
+    with _LOCK:
+        if _EMBEDDING_EXECUTOR is None:
+            _EMBEDDING_EXECUTOR = ThreadPoolExecutor(max_workers=get_limit("embedding_workers", os.cpu_count() or 1), thread_name_prefix="embed")
+        return _EMBEDDING_EXECUTOR
+
+def get_embedding_function(model: str = "default"):
+    if model not in EMBEDDING_MAPPER:
+        raise ValueError(f"Unknown embedding model: {model}")
+    with _LOCK:
+        if model not in _EMBEDDING_FUNCTIONS:
+            embedding_function = EMBEDDING_MAPPER[model]()
+            if _EMBEDDING_CONFIG.get("cache", True):
+                model_name = getattr(embedding_function, "MODEL_NAME", model)
+                embedding_function = CachedEmbeddingFunction(
+                    embedding_function,
+                    model_name,
+                    path=CACHE_PATH / "embeddings.sqlite3" if _EMBEDDING_CONFIG.get("disk_cache", True) else None,
+                    memory_items=_EMBEDDING_CONFIG.get("memory_items", 10000),
+                    max_disk_bytes=_EMBEDDING_CONFIG.get("max_disk_mb", 512) * 1024 * 1024,
+                )
+            _EMBEDDING_FUNCTIONS[model] = embedding_function
+        return _EMBEDDING_FUNCTIONS[model]
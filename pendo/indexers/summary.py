@@ -1,10 +1,16 @@
 from .base import BaseIndexer
+from .registry import get_embedding_executor
+from pendo.core import get_semaphore
 from pendo.dataloaders import ChunkedDoc
 from pendo.llms import get_llm, Message, MessageRole
 
 from asyncio import Semaphore
-from typing import List
-from tqdm.asyncio import tqdm_asyncio
+from functools import partial
+from typing import Dict, List
+
+import asyncio
+import json
+import logging
 
 class SummaryIndexer(BaseIndexer):
 
@@ -14,27 +20,153 @@ class SummaryIndexer(BaseIndexer):
         super().__init__(name, **kwargs)
         self.llm = get_llm(kwargs.get("llm", "openai-gpt3.5-16k"))
         self.semaphore = Semaphore(kwargs.get("llm_coroutines", 20))
+        # Docs longer than max_input_tokens are summarized in groups of at most group_tokens, then reduced
+        self.max_input_tokens = kwargs.get("max_input_tokens", 12000)
+        self.group_tokens = kwargs.get("group_tokens", 6000)
+        # Docs of at most pack_doc_tokens are summarized together, up to pack_tokens and pack_max_docs per request
+        self.pack_short_docs = kwargs.get("pack_short_docs", False)
+        self.pack_doc_tokens = kwargs.get("pack_doc_tokens", 1024)
+        self.pack_tokens = kwargs.get("pack_tokens", 8000)
+        self.pack_max_docs = kwargs.get("pack_max_docs", 10)
 
         self.summary_prompt = "Read the article, and summarize in no more than 8 sentences on behalf of the author. Make sure to cover the main points of the article in the summary. "
+        self.partial_summary_prompt = "Read this part of an article, and summarize it in no more than 8 sentences on behalf of the author. Make sure to cover the main points of this part in the summary. "
+        self.reduce_prompt = "Read the summaries of consecutive parts of an article, and combine them into one summary of no more than 8 sentences on behalf of the author. Make sure to cover the main points of the whole article in the summary. "
+        self.packed_summary_prompt = "Read the articles, each wrapped in <article id=\"n\"> tags, and summarize every article separately in no more than 8 sentences on behalf of its author. Make sure to cover the main points of each article in its summary. Reply only with a JSON object that maps every article id to its summary, e.g. {\"1\": \"...\", \"2\": \"...\"}. "
 
 
     async def index_docs(self, docs: List[ChunkedDoc]):
-        await tqdm_asyncio.gather(*[self._get_summary(doc) for doc in docs])
+        if not self.pack_short_docs:
+            await asyncio.gather(*[self._get_summary(doc) for doc in docs])
+            return
+
+        packs = []
+        long_docs = []
+        current_pack = []
+        current_tokens = 0
+        for doc in docs:
+            num_tokens = sum(self._chunk_tokens(doc))
+            if num_tokens > self.pack_doc_tokens:
+                long_docs.append(doc)
+                continue
+            if len(current_pack) >= self.pack_max_docs or (current_tokens + num_tokens > self.pack_tokens and len(current_pack) > 0):
+                packs.append(current_pack)
+                current_pack = []
+                current_tokens = 0
+            current_pack.append(doc)
+            current_tokens += num_tokens
+        if len(current_pack) > 0:
+            packs.append(current_pack)
+
+        await asyncio.gather(*[self._get_summary(doc) for doc in long_docs], *[self._get_packed_summaries(pack) for pack in packs])
+
+    def _chunk_tokens(self, doc: ChunkedDoc) -> List[int]:
+        if doc.chunk_tokens is not None:
+            return doc.chunk_tokens
+        return [len(self.llm.tokenizer.encode(chunk)) for chunk in doc.chunks]
 
     async def _get_summary(self, doc, temperature=0.6):
-        full_text = "\n".join(doc.chunks)
+        chunk_tokens = self._chunk_tokens(doc)
+
+        if sum(chunk_tokens) <= self.max_input_tokens:
+            summary = await self._summarize("\n".join(doc.chunks), self.summary_prompt, temperature)
+        else:
+            summary = await self._map_reduce(doc.chunks, chunk_tokens, temperature)
+
+        await self._upsert_summaries([doc], [summary])
+
+    async def _get_packed_summaries(self, docs, temperature=0.6):
+        if len(docs) == 1:
+            await self._get_summary(docs[0], temperature)
+            return
+
+        text = "\n\n".join([f"<article id=\"{i+1}\">\n" + "\n".join(doc.chunks) + "\n</article>" for i, doc in enumerate(docs)])
+        reply = await self._summarize(text, self.packed_summary_prompt, temperature)
+        summaries = self._parse_packed_summaries(reply, len(docs))
+        if summaries is None:
+            logging.warning(f"{self.name}: unable to parse summaries of {len(docs)} packed docs, summarizing them one by one")
+            await asyncio.gather(*[self._get_summary(doc, temperature) for doc in docs])
+            return
+
+        await self._upsert_summaries(docs, summaries)
+
+    def _parse_packed_summaries(self, reply: str, num_docs: int) -> List[str]:
+        start = reply.find("{")
+        end = reply.rfind("}")
+        if start < 0 or end < start:
+            return None
+        try:
+            parsed: Dict = json.loads(reply[start:end+1])
+        except json.JSONDecodeError:
+            return None
+        if not isinstance(parsed, dict):
+            return None
+
+        summaries = []
+        for i in range(num_docs):
+            summary = parsed.get(str(i+1), None)
+            if not isinstance(summary, str) or len(summary.strip()) == 0:
+                return None
+            summaries.append(summary.strip())
+        return summaries
+
+    async def _upsert_summaries(self, docs: List[ChunkedDoc], summaries: List[str]):
+        metadatas = []
+        for doc in docs:
+            metadata = {"title": doc.title, "last_edited_time": doc.last_edited_time}
+            for k, v in doc.metadata.items():
+                if v is None:
+                    continue
+                metadata[k] = v
+            metadatas.append(metadata)
+        # The upsert embeds the summaries, so it runs on the embedding pool instead of the event loop
+        await asyncio.get_running_loop().run_in_executor(get_embedding_executor(), partial(
+            self.index.upsert,
+            ids = [doc.id for doc in docs],
+            metadatas = metadatas,
+            documents = summaries,
+        ))
+
+    async def _summarize(self, text, prompt, temperature):
         async with self.semaphore:
-            result, usage = await self.llm.chat_completion_async(
-                    messages = [Message(MessageRole.SYSTEM, self.summary_prompt), Message(MessageRole.USER, full_text)],
-                    temperature = temperature,
-            )
-        metadata = {"title": doc.title, "last_edited_time": doc.last_edited_time}
-        for k, v in doc.metadata.items():
-            if v is None:
-                continue
-            metadata[k] = v
-        self.index.upsert(
-            ids = [doc.id],
-            metadatas = [metadata],
-            documents = [result.content],
-        )
\ No newline at end of file
+            # Also bounded by the llm_calls limit shared by all summary indexers
+            global_semaphore = get_semaphore("llm_calls")
+            if global_semaphore is None:
+                result, usage = await self._chat(text, prompt, temperature)
+            else:
+                async with global_semaphore:
+                    result, usage = await self._chat(text, prompt, temperature)
+        return result.content
+
+    async def _chat(self, text, prompt, temperature):
+        return await self.llm.chat_completion_async(
+                messages = [Message(MessageRole.SYSTEM, prompt), Message(MessageRole.USER, text)],
+                temperature = temperature,
+        )
+
+    """
+    Summarize groups of consecutive texts in parallel, and reduce the partial summaries
+    in further rounds until they fit into a single request
+    """
+    async def _map_reduce(self, texts, text_tokens, temperature):
+        groups = []
+        current_group = []
+        current_tokens = 0
+        for text, num_tokens in zip(texts, text_tokens):
+            if current_tokens + num_tokens > self.group_tokens and len(current_group) > 0:
+                groups.append("\n".join(current_group))
+                current_group = []
+                current_tokens = 0
+            current_group.append(text)
+            current_tokens += num_tokens
+        if len(current_group) > 0:
+            groups.append("\n".join(current_group))
+
+        summaries = await asyncio.gather(*(self._summarize(group, self.partial_summary_prompt, temperature) for group in groups))
+        summary_tokens = [len(self.llm.tokenizer.encode(summary)) for summary in summaries]
+
+        if sum(summary_tokens) <= self.max_input_tokens:
+            return await self._summarize("\n\n".join(summaries), self.reduce_prompt, temperature)
+        if sum(summary_tokens) >= sum(text_tokens):
+            raise ValueError(f"SummaryIndexer: partial summaries of {sum(text_tokens)} tokens did not get shorter")
+        return await self._map_reduce(summaries, summary_tokens, temperature)
\ No newline at end of file
@@ -0,0 +1,130 @@
+from pendo.dataloaders import BaseDataloader, ChunkedDoc, DocRecord
+from pendo.indexers import BaseIndexer
+from pendo.journal import IngestJournal
+
+from asyncio import Queue
+from typing import Dict, List, Union
+from tqdm import tqdm
+
+import asyncio
+
+_DONE = object()
+
+
+"""
+Stream documents through fetch & chunk -> fan-out to indexers. Stages are connected by
+bounded queues, so a slow indexer holds back fetching instead of letting documents pile
+up in memory, and each indexer consumes micro-batches of `batch_size` docs as they arrive,
+up to `index_workers` batches at once so their embeddings and llm calls overlap.
+Batches finished by an indexer are recorded in `journal`, and docs it already holds are skipped.
+"""
+async def ingest(
+    dataloader: BaseDataloader,
+    indexers: Dict[str, BaseIndexer],
+    doc_ids: List[Union[str, DocRecord]],
+    fetch_workers: int = 16,
+    queue_size: int = 64,
+    batch_size: int = 16,
+    index_workers: int = 4,
+    position: int = None,
+    journal: IngestJournal = None,
+):
+    pending = Queue(maxsize=queue_size)
+    indexer_queues = {name: Queue(maxsize=queue_size) for name in indexers}
+    # One progress bar per dataloader, at its own line when several sync at once
+    progress = tqdm(total=len(doc_ids), desc=f"{dataloader.name}", position=position)
+
+    async def feed():
+        for doc_id in doc_ids:
+            await pending.put(doc_id)
+        for _ in range(fetch_workers):
+            await pending.put(_DONE)
+
+    def is_done(doc_id, last_edited_time, name):
+        return journal is not None and journal.is_done(doc_id, last_edited_time, name)
+
+    async def fetch():
+        while True:
+            doc_id = await pending.get()
+            if doc_id is _DONE:
+                return
+            # Records carry their last edited time, so finished docs are not even fetched
+            if isinstance(doc_id, DocRecord) and all(is_done(doc_id.id, doc_id.last_edited_time, name) for name in indexers):
+                progress.update(1)
+                continue
+            doc = await dataloader.retrieve_chunked_doc(doc_id)
+            for name, queue in indexer_queues.items():
+                if not is_done(doc.id, doc.last_edited_time, name):
+                    await queue.put(doc)
+            progress.update(1)
+
+    async def fetch_all():
+        await asyncio.gather(*(fetch() for _ in range(fetch_workers)))
+        for queue in indexer_queues.values():
+            await queue.put(_DONE)
+
+    async def index_batch(name: str, indexer: BaseIndexer, batch: List[ChunkedDoc], workers: asyncio.Semaphore):
+        try:
+            await indexer.index_docs(batch)
+            if journal is not None:
+                await journal.record([(doc.id, doc.last_edited_time, name) for doc in batch])
+        finally:
+            workers.release()
+
+    async def index(name: str, indexer: BaseIndexer, queue: Queue):
+        workers = asyncio.Semaphore(index_workers)
+        batches = set()
+        # Set by the first batch that fails, which stops taking docs right away
+        failed = asyncio.get_running_loop().create_future()
+
+        def batch_done(task):
+            batches.discard(task)
+            if not task.cancelled() and task.exception() is not None and not failed.done():
+                failed.set_exception(task.exception())
+
+        async def next_doc():
+            get = asyncio.ensure_future(queue.get())
+            await asyncio.wait([get, failed], return_when=asyncio.FIRST_COMPLETED)
+            if failed.done():
+                get.cancel()
+                failed.result()
+            return get.result()
+
+        try:
+            done = False
+            while not done:
+                batch: List[ChunkedDoc] = []
+                while len(batch) < batch_size:
+                    doc = await next_doc()
+                    if doc is _DONE:
+                        done = True
+                        break
+                    batch.append(doc)
+                if len(batch) > 0:
+                    # No more docs are taken from the queue while index_workers batches are in flight
+                    await workers.acquire()
+                    task = asyncio.ensure_future(index_batch(name, indexer, batch, workers))
+                    batches.add(task)
+                    task.add_done_callback(batch_done)
+            await asyncio.gather(*batches)
+        except BaseException:
+            for task in batches:
+                task.cancel()
+            await asyncio.gather(*batches, return_exceptions=True)
+            raise
+        finally:
+            # Retrieved here if it was set after the last doc was taken
+            if failed.done() and not failed.cancelled():
+                failed.exception()
+
+    tasks = [asyncio.ensure_future(feed()), asyncio.ensure_future(fetch_all())]
+    tasks.extend([asyncio.ensure_future(index(name, indexers[name], queue)) for name, queue in indexer_queues.items()])
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    finally:
+        progress.close()
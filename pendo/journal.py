@@ -0,0 +1,77 @@
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import asyncio
+import json
+import logging
+import os
+import threading
+
+
+class IngestJournal():
+    """
+    Append-only record of the (doc_id, last_edited_time, indexer) entries an ingestion has
+    finished, so a sync interrupted before its timestamp is saved can skip them on restart.
+    Every batch is fsynced as one write off the event loop, and a torn last line is ignored
+    when loading.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._done: Dict[Tuple[str, str], str] = {}
+        # Indexers record batches concurrently, and their appends must not interleave
+        self._write_lock = threading.Lock()
+
+        lines = 0
+        if path.exists():
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self._done[(entry["doc_id"], entry["indexer"])] = entry["last_edited_time"]
+                    except (json.JSONDecodeError, KeyError, TypeError):
+                        logging.warning(f"Ignoring a corrupted entry in {path}")
+                    lines += 1
+        if lines > len(self._done):
+            self.compact()
+
+    def __len__(self):
+        return len(self._done)
+
+    def is_done(self, doc_id: str, last_edited_time: str, indexer: str) -> bool:
+        # A doc without a last_edited_time is only done if it was recorded
+        key = (doc_id, indexer)
+        return key in self._done and self._done[key] == last_edited_time
+
+    async def record(self, entries: List[Tuple[str, str, str]]):
+        if len(entries) == 0:
+            return
+        lines = []
+        for doc_id, last_edited_time, indexer in entries:
+            self._done[(doc_id, indexer)] = last_edited_time
+            lines.append(json.dumps({"doc_id": doc_id, "last_edited_time": last_edited_time, "indexer": indexer}) + "\n")
+        await asyncio.to_thread(self._append, "".join(lines))
+
+    def _append(self, data: str):
+        with self._write_lock:
+            with open(self.path, "a") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def compact(self):
+        # Keep the latest entry of every (doc_id, indexer), replacing the journal atomically
+        tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        with self._write_lock:
+            with open(tmp_path, "w") as f:
+                for (doc_id, indexer), last_edited_time in self._done.items():
+                    f.write(json.dumps({"doc_id": doc_id, "last_edited_time": last_edited_time, "indexer": indexer}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+
+    def clear(self):
+        # Everything recorded is covered by the saved timestamp from now on
+        self._done = {}
+        if self.path.exists():
+            self.path.unlink()
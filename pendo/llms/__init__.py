@@ -2,6 +2,9 @@ from .message import *
 from .openai import OpenAILlm
 from .llama import LlamaLlm
 from .base import LlmUsage, BaseLlm
+from .scheduler import LlmScheduler
+from .cache import LlmResponseCache
+from pendo.core import CACHE_PATH
 
 LLM_MAPPING = {
     "openai": OpenAILlm,
@@ -9,6 +12,10 @@ LLM_MAPPING = {
 }
 
 REGISERED_LLM = {}
+REGISTERED_SCHEDULERS = {}
+REGISTERED_CACHES = {}
+# Every llm handed out, closed together on shutdown
+CREATED_LLMS = []
 
 def register_llms(config):
     REGISERED_LLM.update(config)
@@ -18,4 +25,22 @@ def get_llm(registered_name):
         raise ValueError(f"Unknown llm: {registered_name}")
     llm_type = REGISERED_LLM[registered_name]["type"]
     kwargs = REGISERED_LLM[registered_name]["params"]
-    return LLM_MAPPING[llm_type](**kwargs)
+    # Every instance of a registered llm shares one scheduler, and so its rate limits
+    if registered_name not in REGISTERED_SCHEDULERS:
+        REGISTERED_SCHEDULERS[registered_name] = LlmScheduler(**(REGISERED_LLM[registered_name].get("rate_limit", None) or {}))
+    cache_config = REGISERED_LLM[registered_name].get("cache", None)
+    if cache_config and registered_name not in REGISTERED_CACHES:
+        cache_config = cache_config if isinstance(cache_config, dict) else {}
+        ttl_hours = cache_config.get("ttl_hours", None)
+        REGISTERED_CACHES[registered_name] = LlmResponseCache(
+            CACHE_PATH / f"llm_{registered_name}.sqlite3",
+            ttl=ttl_hours * 3600 if ttl_hours is not None else None,
+            max_entries=cache_config.get("max_entries", 100000),
+        )
+    llm = LLM_MAPPING[llm_type](scheduler=REGISTERED_SCHEDULERS[registered_name], cache=REGISTERED_CACHES.get(registered_name, None), **kwargs)
+    CREATED_LLMS.append(llm)
+    return llm
+
+async def close_llms():
+    while len(CREATED_LLMS) > 0:
+        await CREATED_LLMS.pop().close()
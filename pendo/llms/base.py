@@ -1,15 +1,128 @@
 from abc import ABC
-from typing import List
+from functools import partial
+from typing import Callable, List, Optional, Tuple
 from .message import Message
+from .scheduler import LlmScheduler
+from .cache import LlmResponseCache
 from dataclasses import dataclass
-from datetime import timedelta
+from datetime import datetime, timedelta
+
+import asyncio
 
 class BaseLlm(ABC):
-    def __init__(self, max_tokens=4096):
+    def __init__(self, max_tokens=4096, scheduler: LlmScheduler = None, cache: LlmResponseCache = None):
         self.max_tokens = max_tokens
         self.total_usage = LlmUsage(completion_tokens=0, prompt_tokens=0, response_time=timedelta(0))
+        self.scheduler = scheduler
+        self.cache = cache
+        self._tokenizer = None
+
+    @property
+    def model_name(self) -> str:
+        return type(self).__name__
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            import tiktoken
+            self._tokenizer = tiktoken.get_encoding("cl100k_base")
+        return self._tokenizer
+
+    def _count_prompt_tokens(self, messages: List[Message]) -> int:
+        # Every message is wrapped in 3 tokens, and the reply is primed with 3 more
+        num_tokens = 3
+        for message in messages:
+            num_tokens += 3 + len(self.tokenizer.encode(message.role)) + len(self.tokenizer.encode(message.content))
+        return num_tokens
+
+    def _retry_policy(self, e: Exception) -> Optional[Tuple[bool, Optional[float]]]:
+        return None
+
+    async def close(self):
+        # Release connection pools and other resources bound to the event loop
+        pass
     
-    def chat_completion(self, messages : List[Message]) -> Message:
+    def _cached_completion(self, key: str) -> Optional[Tuple[Message, "LlmUsage"]]:
+        start_time = datetime.now()
+        cached = self.cache.get(key)
+        if cached is None:
+            return None
+        usage = LlmUsage(0, 0, datetime.now() - start_time, cache_hits=1)
+        self.total_usage += usage
+        return cached["message"], usage
+
+    def _cache_completion(self, key: str, reply: Message, usage: "LlmUsage"):
+        usage.cache_misses = 1
+        self.total_usage.cache_misses += 1
+        self.cache.put(key, reply, usage.completion_tokens, usage.prompt_tokens)
+
+    async def _cached_completion_async(self, key: str) -> Optional[Tuple[Message, "LlmUsage"]]:
+        # SQLite commits on every lookup, so it runs off the event loop, and the usage on it
+        start_time = datetime.now()
+        cached = await asyncio.to_thread(self.cache.get, key)
+        if cached is None:
+            return None
+        usage = LlmUsage(0, 0, datetime.now() - start_time, cache_hits=1)
+        self.total_usage += usage
+        return cached["message"], usage
+
+    async def _cache_completion_async(self, key: str, reply: Message, usage: "LlmUsage"):
+        usage.cache_misses = 1
+        self.total_usage.cache_misses += 1
+        await asyncio.to_thread(self.cache.put, key, reply, usage.completion_tokens, usage.prompt_tokens)
+
+    def chat_completion(self, messages : List[Message], **kwargs) -> Message:
+        if self.cache is None:
+            return self._chat_completion(messages, **kwargs)
+
+        key = self.cache.make_key(self.model_name, messages, kwargs)
+        cached = self._cached_completion(key)
+        if cached is not None:
+            return cached
+        reply, usage = self._chat_completion(messages, **kwargs)
+        self._cache_completion(key, reply, usage)
+        return reply, usage
+
+    """
+    Async requests are answered from the response cache if possible, and otherwise go
+    through the scheduler shared by every user of this llm
+    """
+    async def chat_completion_async(self, messages : List[Message], **kwargs) -> Message:
+        key = None
+        if self.cache is not None:
+            key = self.cache.make_key(self.model_name, messages, kwargs)
+            cached = await self._cached_completion_async(key)
+            if cached is not None:
+                return cached
+
+        if self.scheduler is None:
+            reply, usage = await self._chat_completion_async(messages, **kwargs)
+        else:
+            estimated_tokens = self._count_prompt_tokens(messages) + self.scheduler.expected_completion_tokens
+            reply, usage = await self.scheduler.run(partial(self._chat_completion_async, messages, **kwargs), estimated_tokens, self._retry_policy)
+            self.scheduler.settle(estimated_tokens, usage.total_tokens)
+
+        if key is not None:
+            await self._cache_completion_async(key, reply, usage)
+        return reply, usage
+
+    async def chat_completion_stream_async(self, messages : List[Message], **kwargs) -> "StreamedChatCompletion":
+        if self.scheduler is None:
+            return await self._chat_completion_stream_async(messages, **kwargs)
+
+        # The request keeps its slot until the reply has been streamed, and settles its tokens then
+        estimated_tokens = self._count_prompt_tokens(messages) + self.scheduler.expected_completion_tokens
+        stream = await self.scheduler.run(partial(self._chat_completion_stream_async, messages, **kwargs), estimated_tokens, self._retry_policy, hold=True)
+        stream.on_finish = lambda usage: self.scheduler.finish(estimated_tokens, usage.total_tokens if usage is not None else None)
+        return stream
+
+    def _chat_completion(self, messages : List[Message], **kwargs) -> Message:
+        raise NotImplementedError
+
+    async def _chat_completion_async(self, messages : List[Message], **kwargs) -> Message:
+        raise NotImplementedError
+
+    async def _chat_completion_stream_async(self, messages : List[Message], **kwargs) -> "StreamedChatCompletion":
         raise NotImplementedError
     
     def completion(self, prompt: str):
@@ -20,6 +133,9 @@ class LlmUsage:
     completion_tokens: int
     prompt_tokens: int
     response_time: timedelta
+    time_to_first_token: timedelta = None
+    cache_hits: int = 0
+    cache_misses: int = 0
 
     @property
     def total_tokens(self):
@@ -29,12 +145,39 @@ class LlmUsage:
         return LlmUsage(
             completion_tokens=self.completion_tokens + other.completion_tokens,
             prompt_tokens=self.prompt_tokens + other.prompt_tokens,
-            response_time=self.response_time + other.response_time
+            response_time=self.response_time + other.response_time,
+            time_to_first_token=other.time_to_first_token if other.time_to_first_token is not None else self.time_to_first_token,
+            cache_hits=self.cache_hits + other.cache_hits,
+            cache_misses=self.cache_misses + other.cache_misses,
         )
 @dataclass
 class StreamedChatCompletion(ABC):
+    """
+    Async iterator over the content deltas of a chat completion. Once it is exhausted,
+    `reply_message` holds the full reply and `usage` the usage of the request, and
+    `on_finish` is called with the usage, also if the stream is closed early.
+    """
     reply_message: Message = None
     usage: LlmUsage = None
+    on_finish: Callable[[Optional[LlmUsage]], None] = None
+
+    def __aiter__(self):
+        return self._consume()
 
-    def generate(self):
-        raise NotImplementedError
\ No newline at end of file
+    async def _consume(self):
+        deltas = self.generate()
+        try:
+            async for delta in deltas:
+                yield delta
+        finally:
+            await deltas.aclose()
+            self.finish()
+
+    def finish(self):
+        if self.on_finish is not None:
+            on_finish, self.on_finish = self.on_finish, None
+            on_finish(self.usage)
+
+    async def generate(self):
+        raise NotImplementedError
+        yield
\ No newline at end of file
@@ -0,0 +1,83 @@
+from .message import Message, MessageRole
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+
+class LlmResponseCache():
+    """
+    SQLite-backed cache of chat completions keyed by model, messages and sampling parameters.
+    Entries expire after `ttl` seconds, and the least recently used entries are evicted once
+    the cache holds more than `max_entries`.
+    """
+
+    def __init__(self, path: Path, ttl: float = None, max_entries: int = 100000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        # WAL without per-commit fsync keeps cache hits in the microsecond range
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, role TEXT, content TEXT, completion_tokens INTEGER, prompt_tokens INTEGER, created_at REAL, last_used REAL)"
+        )
+        self._db.commit()
+        self._entries = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(model: str, messages: List[Message], params: Dict) -> str:
+        payload = json.dumps({
+            "model": model,
+            "messages": [[MessageRole(message.role).value, message.content] for message in messages],
+            "params": params,
+        }, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._db.execute("SELECT role, content, completion_tokens, prompt_tokens, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            role, content, completion_tokens, prompt_tokens, created_at = row
+            now = time.time()
+            if self.ttl is not None and now - created_at > self.ttl:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._db.commit()
+                self._entries -= 1
+                return None
+            self._db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self._db.commit()
+        return {"message": Message(MessageRole(role), content), "completion_tokens": completion_tokens, "prompt_tokens": prompt_tokens}
+
+    def put(self, key: str, message: Message, completion_tokens: int, prompt_tokens: int):
+        now = time.time()
+        with self._lock:
+            try:
+                cursor = self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, role, content, completion_tokens, prompt_tokens, created_at, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, MessageRole(message.role).value, message.content, completion_tokens, prompt_tokens, now, now),
+                )
+                self._entries += cursor.rowcount
+                if self._entries > self.max_entries:
+                    # Replaced rows are counted as inserts, so recount before evicting
+                    self._entries = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+                if self._entries > self.max_entries:
+                    # Evict down to 90% of the limit in one statement
+                    self._db.execute(
+                        "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used LIMIT ?)",
+                        (self._entries - int(self.max_entries * 0.9),),
+                    )
+                    self._entries = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+                self._db.commit()
+            except sqlite3.Error as e:
+                logging.error(f"Failed to write llm response cache at {self.path}: {e}")
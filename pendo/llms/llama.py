@@ -1,51 +1,191 @@
+import aiohttp
+import asyncio
+import json
+import logging
 import requests
 
-from .base import BaseLlm, LlmUsage
-from typing import List, Tuple
+from .base import BaseLlm, LlmUsage, StreamedChatCompletion
+from pendo.core import parse_retry_after
+from requests.adapters import HTTPAdapter
+from typing import Dict, List, Optional, Tuple
 from .message import Message, MessageRole
 from datetime import datetime
 
 
+class LlamaServerError(ValueError):
+
+    def __init__(self, status: int, headers=None, body: str = None):
+        message = f"LlamaLlm: unexpected response code from server: {status}"
+        if body:
+            # Error bodies are short, but a misconfigured proxy can answer with a whole page
+            message += f": {body[:1000]}"
+        super().__init__(message)
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    @classmethod
+    def from_response(cls, status: int, headers, body: str) -> "LlamaServerError":
+        logging.warning(f"LlamaLlm: server responded with {status}: {body[:1000]}")
+        return cls(status, headers, body)
+
+
+class LlamaStreamedChatCompletion(StreamedChatCompletion):
+
+    def __init__(self, response: aiohttp.ClientResponse, llm: "LlamaLlm", start_time: datetime, **kwargs):
+        super().__init__(**kwargs)
+        self.response = response
+        self.llm = llm
+        self.start_time = start_time
+
+    async def generate(self):
+        role = MessageRole.ASSISTANT
+        contents = []
+        reported_usage = None
+        time_to_first_token = None
+        try:
+            # Server-sent events: one `data: {json}` line per chunk, terminated by `data: [DONE]`
+            async for line in self.response.content:
+                line = line.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                if chunk.get("usage", None) is not None:
+                    reported_usage = chunk["usage"]
+                choices = chunk.get("choices", [])
+                if len(choices) == 0:
+                    continue
+                delta = choices[0].get("delta", {})
+                if delta.get("role", None) == "function":
+                    role = MessageRole.FUNCTION
+                content = delta.get("content", None)
+                if content is None or len(content) == 0:
+                    continue
+                if time_to_first_token is None:
+                    time_to_first_token = datetime.now() - self.start_time
+                contents.append(content)
+                yield content
+        finally:
+            self.response.release()
+        end_time = datetime.now()
+
+        # llama.cpp streams one token per chunk when it does not report usage
+        if reported_usage is not None:
+            self.usage = LlmUsage(reported_usage.get("completion_tokens", 0), reported_usage.get("prompt_tokens", 0), end_time - self.start_time, time_to_first_token)
+        else:
+            self.usage = LlmUsage(len(contents), 0, end_time - self.start_time, time_to_first_token)
+        self.llm.total_usage += self.usage
+        self.reply_message = Message(role, "".join(contents).strip())
+
+
 class LlamaLlm(BaseLlm):
-    
-    def __init__(self, llama_cpp_server_url: str, api_version: str = "v1", **kwargs) -> None:
+
+    def __init__(self, llama_cpp_server_url: str, api_version: str = "v1", pool_size: int = 16, keepalive_timeout: float = 30, timeout: float = 600, **kwargs) -> None:
         # TODO: Validate base_url
         assert llama_cpp_server_url.startswith("http://"), "LlamaLlm: base_url must be a valid http url (e.g. http://localhost:8000)"
         self.base_url = llama_cpp_server_url
         self.api_version = api_version
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+
+        # Keep-alive connection pools, one for blocking calls and one for the event loop
+        self._sync_session = requests.Session()
+        self._sync_session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self._session = None
 
         super().__init__(**kwargs)
-        
+
+    @property
+    def model_name(self) -> str:
+        return f"llama:{self.base_url}"
+
+    @property
+    def chat_completions_url(self) -> str:
+        return "/".join([self.base_url, self.api_version, "chat/completions"])
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        # Created lazily, as the session is bound to the running event loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive_timeout),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._sync_session.close()
+
+    def _retry_policy(self, e: Exception) -> Optional[Tuple[bool, Optional[float]]]:
+        if isinstance(e, LlamaServerError):
+            if e.status == 429:
+                return True, parse_retry_after(e.headers)
+            if e.status in (500, 502, 503, 504):
+                return False, None
+            return None
+        if isinstance(e, (aiohttp.ClientConnectionError, asyncio.TimeoutError)):
+            return False, None
+        return None
 
     def _prepare_messages(self, messages: List[Message]) -> Tuple[List[Message], LlmUsage]:
         return [{"role": message.role, "content": message.content} for message in messages]
 
-    def chat_completion(self, messages: List[Message]) -> Message:
-        messages = self._prepare_messages(messages)
-
-        start_time = datetime.now()
-        response = requests.post("/".join([self.base_url, self.api_version, "chat/completions"]), json={
-            "messages": messages,
+    def _prepare_request(self, messages: List[Message], **kwargs) -> Dict:
+        return {
+            "messages": self._prepare_messages(messages),
             "max_tokens": self.max_tokens,
-        })
-        if response.status_code != 200:
-            print(response.text)
-            raise ValueError(f"LlamaLlm: unexpected response code from server: {response.status_code}")
-        end_time = datetime.now()
+            **kwargs
+        }
 
-        result = response.json()
-
-        usage = LlmUsage(result.get("usage", {}).get("completion_tokens", None), result.get("usage", {}).get("prompt_tokens", None), end_time - start_time)
+    def _parse_reply(self, result: Dict, start_time: datetime, end_time: datetime) -> Tuple[Message, LlmUsage]:
+        usage = LlmUsage(result.get("usage", {}).get("completion_tokens", 0), result.get("usage", {}).get("prompt_tokens", 0), end_time - start_time)
         self.total_usage += usage
-        
+
         reply_message = result.get("choices",[])[0].get("message", {})
         if reply_message["role"] == "assistant":
             return (Message(MessageRole.ASSISTANT, reply_message["content"].strip()), usage)
         if reply_message["role"] == "function":
             return (Message(MessageRole.FUNCTION, reply_message["content"].strip()), usage)
-        
-        raise ValueError(f"OpenAILlm: unexpected role during chat completion: {reply_message['role']}")
 
-    
+        raise ValueError(f"LlamaLlm: unexpected role during chat completion: {reply_message['role']}")
+
+    def _chat_completion(self, messages: List[Message], **kwargs) -> Message:
+        start_time = datetime.now()
+        response = self._sync_session.post(self.chat_completions_url, json=self._prepare_request(messages, **kwargs), timeout=self.timeout)
+        if response.status_code != 200:
+            raise LlamaServerError.from_response(response.status_code, response.headers, response.text)
+        end_time = datetime.now()
+
+        return self._parse_reply(response.json(), start_time, end_time)
+
+    async def _chat_completion_async(self, messages: List[Message], **kwargs) -> Message:
+        session = await self._get_session()
+
+        start_time = datetime.now()
+        async with session.post(self.chat_completions_url, json=self._prepare_request(messages, **kwargs)) as response:
+            if response.status != 200:
+                raise LlamaServerError.from_response(response.status, response.headers, await response.text())
+            result = await response.json()
+        end_time = datetime.now()
+
+        return self._parse_reply(result, start_time, end_time)
+
+    async def _chat_completion_stream_async(self, messages: List[Message], **kwargs) -> LlamaStreamedChatCompletion:
+        session = await self._get_session()
+
+        start_time = datetime.now()
+        response = await session.post(self.chat_completions_url, json=self._prepare_request(messages, stream=True, **kwargs))
+        if response.status != 200:
+            try:
+                raise LlamaServerError.from_response(response.status, response.headers, await response.text())
+            finally:
+                response.release()
+        return LlamaStreamedChatCompletion(response, self, start_time)
+
     def completion(self, prompt: str):
-        raise NotImplementedError
\ No newline at end of file
+        raise NotImplementedError
@@ -31,3 +31,9 @@ class Message():
     def from_json(cls, json_str):
         json_dict = json.loads(json_str)
         return cls(**json_dict)
+
+@dataclass
+class MessageDelta(Message):
+    """
+    A piece of a message streamed from the llm, following the previous deltas.
+    """
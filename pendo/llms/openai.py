@@ -1,23 +1,50 @@
-import openai
-
 from .base import BaseLlm, LlmUsage, StreamedChatCompletion
-from typing import List, Tuple
+from pendo.core import parse_retry_after
+from typing import List, Optional, Tuple
 from .message import Message, MessageRole
 from datetime import datetime
 
-# TODO Stream
+
 class OpenAIStreamedChatCompletion(StreamedChatCompletion):
 
-    def __init__(self, streamed_reply, **kwargs):
+    def __init__(self, streamed_reply, llm: "OpenAILlm", prompt_tokens: int, start_time: datetime, **kwargs):
         super().__init__(**kwargs)
         self.streamed_reply = streamed_reply
-
-    def generate(self):
-        start_time = datetime.now()
-        for chunk in self.streamed_reply:
-            yield chunk
+        self.llm = llm
+        self.prompt_tokens = prompt_tokens
+        self.start_time = start_time
+
+    async def generate(self):
+        role = MessageRole.ASSISTANT
+        contents = []
+        reported_usage = None
+        time_to_first_token = None
+        async for chunk in self.streamed_reply:
+            if chunk.get("usage", None) is not None:
+                reported_usage = chunk["usage"]
+            if len(chunk.choices) == 0:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.get("role", None) == "function":
+                role = MessageRole.FUNCTION
+            content = delta.get("content", None)
+            if content is None or len(content) == 0:
+                continue
+            if time_to_first_token is None:
+                time_to_first_token = datetime.now() - self.start_time
+            contents.append(content)
+            yield content
         end_time = datetime.now()
 
+        content = "".join(contents)
+        # Streamed responses carry no usage unless the server reports it, so count the tokens locally
+        if reported_usage is not None:
+            self.usage = LlmUsage(reported_usage["completion_tokens"], reported_usage["prompt_tokens"], end_time - self.start_time, time_to_first_token)
+        else:
+            self.usage = LlmUsage(len(self.llm.tokenizer.encode(content)), self.prompt_tokens, end_time - self.start_time, time_to_first_token)
+        self.llm.total_usage += self.usage
+        self.reply_message = Message(role, content.strip())
+
 
 class OpenAILlm(BaseLlm):
     
@@ -28,14 +55,42 @@ class OpenAILlm(BaseLlm):
         assert self._model != "", "OpenAILlm: model is empty"
         super().__init__(**kwargs)
 
+    @property
+    def _openai(self):
+        # Imported on first use to keep it out of startup
+        import openai
+        return openai
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            import tiktoken
+            try:
+                self._tokenizer = tiktoken.encoding_for_model(self._model)
+            except KeyError:
+                self._tokenizer = tiktoken.get_encoding("cl100k_base")
+        return self._tokenizer
+
+    def _retry_policy(self, e: Exception) -> Optional[Tuple[bool, Optional[float]]]:
+        error = self._openai.error
+        if isinstance(e, error.RateLimitError):
+            return True, parse_retry_after(e.headers)
+        if isinstance(e, (error.APIError, error.ServiceUnavailableError, error.APIConnectionError, error.Timeout, error.TryAgain)):
+            return False, None
+        return None
+
     def _prepare_messages(self, messages: List[Message]) -> Tuple[List[Message], LlmUsage]:
         return [{"role": message.role, "content": message.content} for message in messages]
 
-    def chat_completion(self, messages: List[Message], stream=False, **kwargs) -> Message:
+    @property
+    def model_name(self) -> str:
+        return self._model
+
+    def _chat_completion(self, messages: List[Message], **kwargs) -> Message:
         messages = self._prepare_messages(messages)
 
         start_time = datetime.now()
-        result = openai.ChatCompletion.create(
+        result = self._openai.ChatCompletion.create(
             api_key = self._openai_api_key,
             model=self._model,
             messages = messages,
@@ -55,11 +110,11 @@ class OpenAILlm(BaseLlm):
         
         raise ValueError(f"OpenAILlm: unexpected role during chat completion: {reply_message.role}")
 
-    async def chat_completion_async(self, messages: List[Message], **kwargs) -> Message:
+    async def _chat_completion_async(self, messages: List[Message], **kwargs) -> Message:
         messages = self._prepare_messages(messages)
 
         start_time = datetime.now()
-        result = await openai.ChatCompletion.acreate(
+        result = await self._openai.ChatCompletion.acreate(
             api_key = self._openai_api_key,
             model=self._model,
             messages = messages,
@@ -79,9 +134,23 @@ class OpenAILlm(BaseLlm):
         
         raise ValueError(f"OpenAILlm: unexpected role during chat completion: {reply_message.role}")
 
+    async def _chat_completion_stream_async(self, messages: List[Message], **kwargs) -> OpenAIStreamedChatCompletion:
+        prompt_tokens = self._count_prompt_tokens(messages)
+        messages = self._prepare_messages(messages)
+
+        start_time = datetime.now()
+        streamed_reply = await self._openai.ChatCompletion.acreate(
+            api_key = self._openai_api_key,
+            model=self._model,
+            messages = messages,
+            stream = True,
+            **kwargs
+        )
+        return OpenAIStreamedChatCompletion(streamed_reply, self, prompt_tokens, start_time)
+
     def completion(self, prompt: str):
         start_time = datetime.now()
-        result = openai.Completion.create(
+        result = self._openai.Completion.create(
             api_key = self._openai_api_key,
             model=self._model,
             prompt = prompt,
@@ -0,0 +1,180 @@
+from collections import deque
+from pendo.core import RetryPolicy, RetryStats, backoff_delay
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+
+class _Budget():
+    """
+    Token bucket holding up to one minute worth of `per_minute`
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def delay(self, amount: float, now: float) -> float:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        # Requests larger than the whole budget are admitted once the bucket is full
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount: float):
+        self.level -= amount
+
+
+class LlmScheduler():
+    """
+    Admits llm requests against requests-per-minute and tokens-per-minute budgets and a
+    concurrency limit, smallest estimated request first, and retries failed requests with
+    jittered exponential backoff or the delay requested by the server. A request that has
+    waited `max_wait` seconds goes next regardless of its size, so large ones never starve.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float = None,
+        tokens_per_minute: float = None,
+        max_concurrency: int = 16,
+        max_retries: int = 5,
+        base_backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        expected_completion_tokens: int = 256,
+        max_wait: float = 30.0,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.expected_completion_tokens = expected_completion_tokens
+        self.max_wait = max_wait
+        self.stats = RetryStats()
+
+        self._requests = _Budget(requests_per_minute) if requests_per_minute else None
+        self._tokens = _Budget(tokens_per_minute) if tokens_per_minute else None
+        # The same waiters by size and by arrival; the one served is left in the other
+        # until it reaches the front
+        self._waiters = []
+        self._arrivals = deque()
+        self._sequence = itertools.count()
+        self._active = 0
+        self._blocked_until = 0.0
+        self._changed = None
+        self._dispatcher = None
+
+    """
+    With `hold`, the slot is kept after the request returns, e.g. while its reply is streamed,
+    and is given back by `finish`
+    """
+    async def run(self, request, estimated_tokens: int, retry_policy: RetryPolicy, hold: bool = False):
+        attempt = 0
+        while True:
+            await self._acquire(estimated_tokens)
+            try:
+                result = await request()
+            except Exception as e:
+                self._release()
+                self.stats.requests += 1
+
+                decision = retry_policy(e)
+                if decision is None or attempt >= self.max_retries:
+                    self.stats.failures += 1
+                    raise e
+                throttled, retry_after = decision
+                delay = backoff_delay(attempt, self.base_backoff, self.max_backoff, retry_after)
+                if throttled:
+                    self.stats.throttles += 1
+                    self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+                attempt += 1
+                self.stats.retries += 1
+                logging.debug(f"Retrying llm request in {delay:.2f}s (attempt {attempt}/{self.max_retries}): {e}")
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                self._release()
+                raise
+            if not hold:
+                self._release()
+            self.stats.requests += 1
+            return result
+
+    def settle(self, estimated_tokens: int, actual_tokens: int):
+        # Correct the token budget once the real usage of a request is known
+        if self._tokens is not None and actual_tokens is not None:
+            self._tokens.take(actual_tokens - estimated_tokens)
+
+    def finish(self, estimated_tokens: int, actual_tokens: int):
+        # Give back the slot of a request run with `hold`
+        self._release()
+        self.settle(estimated_tokens, actual_tokens)
+
+    async def _acquire(self, estimated_tokens: int):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (estimated_tokens, next(self._sequence), future))
+        self._arrivals.append((time.monotonic(), estimated_tokens, future))
+        self._wake()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+
+    def _release(self):
+        self._active -= 1
+        self._wake()
+
+    def _wake(self):
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        self._changed.set()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+
+    async def _dispatch(self):
+        while len(self._waiters) > 0:
+            estimated_tokens, _, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            while self._arrivals[0][2].done():
+                self._arrivals.popleft()
+
+            now = time.monotonic()
+            arrived_at, oldest_tokens, oldest = self._arrivals[0]
+            if self.max_wait is not None and now - arrived_at >= self.max_wait:
+                estimated_tokens, future = oldest_tokens, oldest
+
+            delay = self._blocked_until - now
+            if self._requests is not None:
+                delay = max(delay, self._requests.delay(1, now))
+            if self._tokens is not None:
+                delay = max(delay, self._tokens.delay(estimated_tokens, now))
+
+            if self._active >= self.max_concurrency or delay > 0:
+                self._changed.clear()
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout=delay if delay > 0 else None)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            if future is self._waiters[0][2]:
+                heapq.heappop(self._waiters)
+            if self._requests is not None:
+                self._requests.take(1)
+            if self._tokens is not None:
+                self._tokens.take(estimated_tokens)
+            self._active += 1
+            future.set_result(None)
+        # Every waiter left has been served
+        self._arrivals.clear()
@@ -1,60 +1,165 @@
-from pendo.core import load_config, initialize_workspace_paths
-from pendo.llms import register_llms, get_llm
+from pendo.core import load_config, initialize_workspace_paths, configure_limits, TIMESTAMPS_PATH
+from pendo.llms import register_llms, get_llm, close_llms, MessageDelta
 from pendo.dataloaders import BaseDataloader, get_dataloader
-from pendo.indexers import BaseIndexer, register_indexers, get_indexer
+from pendo.indexers import BaseIndexer, register_indexers, get_indexer, configure_embeddings
 from pendo.agents import PerplexitySearchAgent
+from pendo.ingest import ingest
+from pendo.journal import IngestJournal
+from pendo.daemon import PendoDaemon, PendoClient, is_daemon_running
 
 from datetime import datetime, timedelta
-from tqdm.asyncio import tqdm_asyncio
 
+import argparse
 import asyncio
-import tiktoken
 
-async def main():
+def setup():
     initialize_workspace_paths()
-    
+
     config = load_config()
+    configure_limits(config.get("limits", None) or {})
     register_llms(config["llms"])
+    configure_embeddings(config.get("embeddings", None) or {})
     register_indexers(config["indexers"])
+    return config
 
+async def sync(config):
     dataloaders_config = config["dataloaders"]
-    local_timezone = datetime.now().astimezone().tzinfo
-    
+    # Dataloaders sync concurrently, sharing the global limits, and each keeps its own timestamp
+    results = await asyncio.gather(
+        *[sync_dataloader(k, v, config, position) for position, (k, v) in enumerate(dataloaders_config.items())],
+        return_exceptions=True,
+    )
+    errors = [(k, result) for k, result in zip(dataloaders_config, results) if isinstance(result, BaseException)]
+    for k, e in errors:
+        print(f"{k}: sync failed: {e}")
+    if len(errors) > 0:
+        raise errors[0][1]
 
-    for k, v in dataloaders_config.items():
+async def sync_dataloader(k, v, config, position=None):
+    import tiktoken
+    ingest_config = config.get("ingest", None) or {}
+    local_timezone = datetime.now().astimezone().tzinfo
 
-        dataloader = get_dataloader(v["type"], k, config=v["config"], tokenizer=tiktoken.get_encoding("cl100k_base"))
+    dataloader = get_dataloader(v["type"], k, config=v["config"], tokenizer=tiktoken.get_encoding("cl100k_base"))
+    # Every sync, including those of the daemon, opens its own client, which is closed when it ends
+    try:
         print(f"{k}: checking docs after {dataloader.get_timestamp()}")
         doc_ids = await dataloader.retrieve_doc_ids()
         print(f"{k}: {len(doc_ids)} docs need to be indexed")
         timestamp = datetime.now(tz=local_timezone)
+        # Work finished by an interrupted sync is kept until the timestamp covers it
+        journal = IngestJournal(TIMESTAMPS_PATH / f"{k}.journal.jsonl")
 
         if len(doc_ids) == 0:
             dataloader.save_timestamp(timestamp)
-            continue
+            journal.clear()
+            return
 
-        print(f"{k}: gathering and chunking docs")
-        docs = await tqdm_asyncio.gather(*[dataloader.retrieve_chunked_doc(doc_id) for doc_id in doc_ids])
-        print(f"{k}: indexing {len(docs)} docs")
+        if len(journal) > 0:
+            print(f"{k}: resuming, {len(journal)} indexed docs found in the journal")
 
-        for indexer_name in v.get("indexers", []):
-            print(f"{k}: indexing to `{indexer_name}`")
-            indexer = get_indexer(indexer_name)
-            await indexer.index_docs(docs)
-            print(f"{k}: `{indexer_name}` updated")
+        indexers = {indexer_name: get_indexer(indexer_name) for indexer_name in v.get("indexers", [])}
+        indexer_names = ", ".join([f"`{indexer_name}`" for indexer_name in indexers])
+        print(f"{k}: fetching, chunking and indexing {len(doc_ids)} docs to {indexer_names}")
+        await ingest(dataloader, indexers, doc_ids, position=position, journal=journal, **ingest_config)
+        print(f"{k}: {indexer_names} updated")
+        for indexer_name, indexer in indexers.items():
+            if indexer.stats is not None:
+                print(f"{k}: `{indexer_name}` {indexer.stats}")
         dataloader.save_timestamp(timestamp)
-    
-    agent = PerplexitySearchAgent(get_llm("openai-gpt3.5-16k"), tiktoken.get_encoding("cl100k_base"), get_indexer("summary").index, get_indexer("chunks").index)
+        journal.clear()
+        if dataloader.shared_scheduler:
+            print(f"{k}: notion (all dataloaders) {dataloader.scheduler.stats}")
+        else:
+            print(f"{k}: notion {dataloader.scheduler.stats}")
+    finally:
+        await dataloader.close()
+
+def build_agent(config):
+    import tiktoken
+    agent_config = config.get("agent", None) or {}
+    return PerplexitySearchAgent(
+        get_llm(agent_config.get("llm", "openai-gpt3.5-16k")),
+        tiktoken.get_encoding("cl100k_base"),
+        get_indexer(agent_config.get("summary_indexer", "summary")).index,
+        get_indexer(agent_config.get("chunk_indexer", "chunks")).index,
+        skip_expansion_distance=agent_config.get("skip_expansion_distance", None),
+        search_workers=agent_config.get("search_workers", 8),
+        max_sessions=agent_config.get("max_sessions", 32),
+    )
 
+"""
+Read questions from the prompt and print the answers of `agent`, which is either a local
+agent or a client of the daemon.
+"""
+async def interactive(agent):
+    loop = asyncio.get_running_loop()
     while True:
-        query = input("> ")
+        query = await loop.run_in_executor(None, input, "> ")
         total_usage = None
+        streamed = False
         async for message, usage in agent.run(query):
+            if isinstance(message, MessageDelta):
+                print(message.content, end="", flush=True)
+                streamed = True
+                continue
             if usage is not None:
                 total_usage = usage if total_usage is None else total_usage + usage
-            print(message)
+            if streamed:
+                # The full reply has already been printed delta by delta
+                print()
+                streamed = False
+            else:
+                print(message)
             print("\033[2m" + str(total_usage) + "\033[0m")
 
+async def main():
+    parser = argparse.ArgumentParser(prog="pendo")
+    parser.add_argument("--daemon", action="store_true", help="serve queries over a Unix socket and sync in the background")
+    parser.add_argument("--local", action="store_true", help="answer queries in this process even if a daemon is running, which then keeps syncing")
+    parser.add_argument("--sync", action="store_true", help="ask the running daemon to sync now")
+    args = parser.parse_args()
+
+    daemon_running = not args.daemon and await is_daemon_running()
+    if daemon_running and not args.local:
+        client = PendoClient()
+        try:
+            if args.sync:
+                await client.sync()
+                print("pendo daemon: sync started")
+                return
+            await interactive(client)
+        finally:
+            await client.close()
+        return
+
+    config = setup()
+    if args.daemon:
+        daemon_config = config.get("daemon", None) or {}
+        daemon = PendoDaemon(
+            build_agent(config),
+            lambda: sync(config),
+            sync_interval=daemon_config.get("sync_interval_minutes", 10) * 60,
+        )
+        await daemon.serve()
+        return
+
+    if daemon_running:
+        # The daemon syncs the same indexes, timestamps and journals, which two processes must not share
+        if args.sync:
+            print("pendo daemon is running, use `pendo --sync` to ask it to sync")
+            return
+        print("pendo daemon is running and keeps the indexes up to date, skipping sync")
+    else:
+        await sync(config)
+        if args.sync:
+            return
+    await interactive(build_agent(config))
+
 if __name__ == "__main__":
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(main())
\ No newline at end of file
+    try:
+        loop.run_until_complete(main())
+    finally:
+        # Also on Ctrl-C, so the connection pools of the llms are closed on their loop
+        loop.run_until_complete(close_llms())
@@ -0,0 +1,51 @@
+import threading
+
+import pytest
+
+
+class FakeCollection():
+    """
+    In-memory stand-in for a chroma collection, recording the thread of every call
+    """
+
+    def __init__(self, embedding_function=None):
+        self.embedding_function = embedding_function
+        self.entries = {}
+        self.calls = []
+
+    def _record(self, method):
+        self.calls.append((method, threading.current_thread()))
+
+    def upsert(self, ids, metadatas=None, documents=None, embeddings=None):
+        self._record("upsert")
+        if embeddings is None:
+            embeddings = self.embedding_function(documents)
+        for i, id in enumerate(ids):
+            self.entries[id] = {
+                "embedding": list(embeddings[i]),
+                "metadata": metadatas[i] if metadatas is not None else None,
+                "document": documents[i] if documents is not None else None,
+            }
+
+    def get(self, ids=None, where=None, include=None):
+        self._record("get")
+        selected = list(self.entries) if ids is None else [id for id in ids if id in self.entries]
+        if where is not None:
+            (key, condition), = where.items()
+            selected = [id for id in selected if self.entries[id]["metadata"].get(key) in condition["$in"]]
+        return {
+            "ids": selected,
+            "embeddings": [self.entries[id]["embedding"] for id in selected],
+            "metadatas": [self.entries[id]["metadata"] for id in selected],
+            "documents": [self.entries[id]["document"] for id in selected],
+        }
+
+    def delete(self, ids):
+        self._record("delete")
+        for id in ids:
+            self.entries.pop(id, None)
+
+
+@pytest.fixture
+def collection():
+    return FakeCollection(lambda texts: [[float(len(text)), 1.0] for text in texts])
@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from conftest import FakeCollection
+from pendo.dataloaders import ChunkedDoc
+from pendo.indexers import CentroidIndexer, registry
+from pendo.indexers.chunk import _content_hash
+
+
+class CountingEmbeddingFunction():
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, input):
+        self.calls.append(list(input))
+        return [[1.0, 0.0] for _ in input]
+
+
+@pytest.fixture
+def embedding_function(monkeypatch):
+    embedding_function = CountingEmbeddingFunction()
+    monkeypatch.setattr(registry, "_EMBEDDING_FUNCTIONS", {"default": embedding_function})
+    return embedding_function
+
+def _indexer(chunk_collection):
+    indexer = CentroidIndexer("centroid")
+    indexer._index = FakeCollection()
+    indexer._chunk_index = chunk_collection
+    return indexer
+
+def _store_chunks(collection, doc, embeddings):
+    collection.upsert(
+        ids = [f"{doc.id}_{i+1}" for i in range(len(doc.chunks))],
+        embeddings = embeddings,
+        metadatas = [{"doc_id": doc.id, "chunk_id": i+1, "content_hash": _content_hash(chunk)} for i, chunk in enumerate(doc.chunks)],
+        documents = doc.chunks,
+    )
+
+
+def test_stored_chunk_embeddings_are_reused(embedding_function):
+    chunks = FakeCollection()
+    doc = ChunkedDoc("a", "Alpha", "2024-01-01", ["one", "two"], metadata={}, chunk_tokens=[1, 3])
+    _store_chunks(chunks, doc, [[0.0, 1.0], [1.0, 0.0]])
+    indexer = _indexer(chunks)
+
+    asyncio.run(indexer.index_docs([doc]))
+
+    assert embedding_function.calls == []
+    centroid = np.asarray(indexer.index.entries["a"]["embedding"])
+    expected = np.asarray([3.0, 1.0]) / np.linalg.norm([3.0, 1.0])
+    assert centroid == pytest.approx(expected, abs=1e-6)
+    assert indexer.index.entries["a"]["metadata"]["num_chunks"] == 2
+
+def test_only_changed_chunks_are_embedded(embedding_function):
+    chunks = FakeCollection()
+    _store_chunks(chunks, ChunkedDoc("a", "Alpha", "2024-01-01", ["one", "two"], metadata={}), [[0.0, 1.0], [0.0, 1.0]])
+    indexer = _indexer(chunks)
+
+    doc = ChunkedDoc("a", "Alpha", "2024-02-01", ["one", "changed"], metadata={})
+    asyncio.run(indexer.index_docs([doc]))
+
+    assert embedding_function.calls == [["changed"]]
+    centroid = np.asarray(indexer.index.entries["a"]["embedding"])
+    assert centroid == pytest.approx(np.asarray([1.0, 1.0]) / np.sqrt(2), abs=1e-6)
+
+def test_empty_docs_are_removed(embedding_function):
+    indexer = _indexer(FakeCollection())
+    indexer.index.upsert(ids=["a"], embeddings=[[1.0, 0.0]], metadatas=[{}], documents=["Alpha"])
+
+    asyncio.run(indexer.index_docs([ChunkedDoc("a", "Alpha", "2024-01-01", [], metadata={})]))
+    assert indexer.index.entries == {}
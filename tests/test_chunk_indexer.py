@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+
+from conftest import FakeCollection
+from pendo.dataloaders import ChunkedDoc
+from pendo.indexers import ChunkIndexer, registry
+from pendo.indexers.chunk import _content_hash
+
+
+class CountingEmbeddingFunction():
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, input):
+        self.calls.append(list(input))
+        return [[float(len(text)), float(len(self.calls))] for text in input]
+
+
+@pytest.fixture
+def embedding_function(monkeypatch):
+    embedding_function = CountingEmbeddingFunction()
+    monkeypatch.setattr(registry, "_EMBEDDING_FUNCTIONS", {"default": embedding_function})
+    return embedding_function
+
+@pytest.fixture
+def indexer():
+    indexer = ChunkIndexer("chunk", batch_size=2)
+    indexer._index = FakeCollection()
+    yield indexer
+    indexer.upsert_executor.shutdown()
+
+def _doc(id, chunks):
+    return ChunkedDoc(id, f"Title {id}", "2024-01-01", chunks, metadata={"source": None, "date": "2024"}, chunk_tokens=[len(chunk) for chunk in chunks])
+
+def _embedded(embedding_function):
+    return sorted(text for call in embedding_function.calls for text in call)
+
+
+def test_chunks_are_embedded_in_batches(indexer, embedding_function):
+    asyncio.run(indexer.index_docs([_doc("a", ["one", "two", "three"]), _doc("b", ["four"])]))
+
+    assert sorted(len(call) for call in embedding_function.calls) == [2, 2]
+    assert sorted(indexer.index.entries) == ["a_1", "a_2", "a_3", "b_1"]
+    assert indexer.index.entries["a_3"]["metadata"] == {"title": "Title a", "last_edited_time": "2024-01-01", "doc_id": "a", "chunk_id": 3, "content_hash": _content_hash("three"), "num_tokens": 5, "date": "2024"}
+    assert (indexer.stats.embeddings, indexer.stats.skipped, indexer.stats.deleted) == (4, 0, 0)
+
+def test_unchanged_and_moved_chunks_keep_their_embedding(indexer, embedding_function):
+    asyncio.run(indexer.index_docs([_doc("a", ["one", "two", "three"])]))
+    before = {id: entry["embedding"] for id, entry in indexer.index.entries.items()}
+    embedding_function.calls.clear()
+
+    # "one" is unchanged, "two" and "three" move down by one after a new chunk
+    asyncio.run(indexer.index_docs([_doc("a", ["one", "new", "two", "three"])]))
+
+    assert _embedded(embedding_function) == ["new"]
+    entries = indexer.index.entries
+    assert [entries[f"a_{i}"]["document"] for i in range(1, 5)] == ["one", "new", "two", "three"]
+    assert entries["a_1"]["embedding"] == before["a_1"]
+    assert entries["a_3"]["embedding"] == before["a_2"]
+    assert entries["a_4"]["embedding"] == before["a_3"]
+    assert [entries[f"a_{i}"]["metadata"]["chunk_id"] for i in range(1, 5)] == [1, 2, 3, 4]
+    assert (indexer.stats.skipped, indexer.stats.deleted) == (3, 0)
+
+def test_embeddings_are_not_shared_across_docs(indexer, embedding_function):
+    asyncio.run(indexer.index_docs([_doc("a", ["same"])]))
+    embedding_function.calls.clear()
+
+    asyncio.run(indexer.index_docs([_doc("b", ["same"])]))
+
+    assert _embedded(embedding_function) == ["same"]
+
+def test_stale_chunks_are_deleted(indexer, embedding_function):
+    asyncio.run(indexer.index_docs([_doc("a", ["one", "two", "three"]), _doc("b", ["four", "five"])]))
+    embedding_function.calls.clear()
+
+    asyncio.run(indexer.index_docs([_doc("a", ["one"])]))
+
+    assert embedding_function.calls == []
+    assert sorted(indexer.index.entries) == ["a_1", "b_1", "b_2"]
+    assert indexer.stats.deleted == 2
@@ -0,0 +1,125 @@
+import asyncio
+import json
+
+import pytest
+
+from pendo.daemon import PendoClient, PendoDaemon, is_daemon_running
+from pendo.llms import LlmUsage, Message, MessageDelta, MessageRole
+
+from datetime import timedelta
+
+
+class StubAgent():
+
+    async def run(self, query):
+        if query == "boom":
+            yield MessageDelta(MessageRole.ASSISTANT, "partial"), None
+            raise ValueError("agent failed")
+        yield MessageDelta(MessageRole.ASSISTANT, "Hel"), None
+        yield MessageDelta(MessageRole.ASSISTANT, "lo"), None
+        yield Message(MessageRole.ASSISTANT, f"Hello, {query}"), LlmUsage(2, 3, timedelta(seconds=1))
+
+
+def _serve(tmp_path, test):
+    path = tmp_path / "pendo.sock"
+    syncs = []
+
+    async def sync():
+        syncs.append(None)
+
+    async def run():
+        daemon = PendoDaemon(StubAgent(), sync, sync_interval=3600, path=path)
+        server = asyncio.ensure_future(daemon.serve())
+        while not await is_daemon_running(path):
+            await asyncio.sleep(0.01)
+        client = PendoClient(path)
+        try:
+            await asyncio.wait_for(test(client, path), timeout=10)
+        finally:
+            await client.close()
+            server.cancel()
+            await asyncio.gather(server, return_exceptions=True)
+
+    asyncio.run(run())
+    return syncs
+
+
+def test_query_is_streamed(tmp_path):
+    async def test(client, path):
+        replies = [reply async for reply in client.run("world")]
+        assert [message.content for message, _ in replies] == ["Hel", "lo", "Hello, world"]
+        assert isinstance(replies[0][0], MessageDelta)
+        assert replies[-1][1].total_tokens == 5
+        assert replies[-1][1].response_time == timedelta(seconds=1)
+
+    _serve(tmp_path, test)
+
+def test_failed_query_ends_the_answer(tmp_path):
+    async def test(client, path):
+        with pytest.raises(RuntimeError, match="agent failed"):
+            async for _ in client.run("boom"):
+                pass
+        # The connection is still in step with the daemon
+        replies = [reply async for reply in client.run("again")]
+        assert replies[-1][0].content == "Hello, again"
+
+    _serve(tmp_path, test)
+
+def test_bad_requests_get_an_error_and_done(tmp_path):
+    async def test(client, path):
+        reader, writer = await asyncio.open_unix_connection(str(path))
+        try:
+            for request in [b"not json\n", b"[1, 2]\n", b'{"command": "dance"}\n']:
+                writer.write(request)
+                await writer.drain()
+                assert json.loads(await reader.readline())["type"] == "error"
+                assert json.loads(await reader.readline()) == {"type": "done"}
+        finally:
+            writer.close()
+
+    _serve(tmp_path, test)
+
+def test_sync_command(tmp_path):
+    async def test(client, path):
+        await client.sync()
+        await asyncio.sleep(0.05)
+
+    # Once at startup and once on request
+    assert len(_serve(tmp_path, test)) == 2
+
+def test_notion_dataloader_closes_its_client(tmp_path):
+    pytest.importorskip("notion_client")
+    from pendo.dataloaders import NotionDataloader
+
+    dataloader = NotionDataloader("primary", {"database_id": "db", "title_prop": "Title", "relation_cache_on_disk": False, "response_cache": False}, tokenizer=None)
+    asyncio.run(dataloader.close())
+    assert dataloader.notion_client.client.is_closed
+
+def test_requested_sync_is_kept_and_cancelled_on_shutdown(tmp_path):
+    path = tmp_path / "pendo.sock"
+    started = []
+
+    async def sync():
+        started.append(None)
+        if len(started) > 1:
+            await asyncio.sleep(3600)
+
+    async def run():
+        daemon = PendoDaemon(StubAgent(), sync, sync_interval=3600, path=path)
+        server = asyncio.ensure_future(daemon.serve())
+        while not await is_daemon_running(path):
+            await asyncio.sleep(0.01)
+        client = PendoClient(path)
+        await client.sync()
+        await client.close()
+        while len(started) < 2:
+            await asyncio.sleep(0.01)
+        tasks = set(daemon._sync_tasks)
+        assert len(tasks) == 1
+        server.cancel()
+        await asyncio.gather(server, return_exceptions=True)
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return tasks
+
+    tasks = asyncio.run(asyncio.wait_for(run(), timeout=10))
+    assert all(task.cancelled() for task in tasks)
@@ -0,0 +1,120 @@
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+from pendo.indexers.embeddings import CachedEmbeddingFunction
+
+
+class CountingEmbeddingFunction():
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, input):
+        self.calls.append(list(input))
+        return [[float(len(text)), 0.1, -2.5] for text in input]
+
+
+def test_repeated_texts_are_served_from_memory():
+    embedding_function = CountingEmbeddingFunction()
+    cached = CachedEmbeddingFunction(embedding_function, "test")
+
+    first = cached(["a", "bb", "a"])
+    second = cached(["bb", "a"])
+    assert embedding_function.calls == [["a", "bb"]]
+    assert second == [first[1], first[0]]
+    assert cached.hits == 2
+    assert cached.misses == 2
+
+def test_vectors_are_float32_in_memory_and_lists_outside():
+    cached = CachedEmbeddingFunction(CountingEmbeddingFunction(), "test")
+
+    embeddings = cached(["abc"])
+    assert all(isinstance(vector, array) and vector.typecode == "f" for vector in cached._memory.values())
+    assert isinstance(embeddings[0], list)
+    # Fresh embeddings are rounded through float32 exactly like cached ones
+    assert embeddings == [list(array("f", [3.0, 0.1, -2.5]))]
+    assert cached(["abc"]) == embeddings
+
+def test_memory_is_bounded():
+    cached = CachedEmbeddingFunction(CountingEmbeddingFunction(), "test", memory_items=2)
+
+    cached(["a", "b", "c"])
+    assert len(cached._memory) == 2
+
+def test_disk_cache_survives_restart(tmp_path):
+    path = tmp_path / "embeddings.sqlite3"
+    embeddings = CachedEmbeddingFunction(CountingEmbeddingFunction(), "test", path=path)(["hello", "world"])
+
+    embedding_function = CountingEmbeddingFunction()
+    cached = CachedEmbeddingFunction(embedding_function, "test", path=path)
+    assert cached(["world", "hello"]) == [embeddings[1], embeddings[0]]
+    assert embedding_function.calls == []
+
+    # Another model never reads these vectors
+    other = CountingEmbeddingFunction()
+    CachedEmbeddingFunction(other, "other", path=path)(["hello"])
+    assert other.calls == [["hello"]]
+
+def test_disk_cache_is_trimmed(tmp_path):
+    row_bytes = 3 * 4
+    cached = CachedEmbeddingFunction(CountingEmbeddingFunction(), "test", path=tmp_path / "embeddings.sqlite3", max_disk_bytes=10 * row_bytes)
+
+    for i in range(30):
+        cached([f"text {i}"])
+    assert cached._disk_bytes <= 10 * row_bytes
+
+def test_counters_are_exact_across_threads():
+    cached = CachedEmbeddingFunction(CountingEmbeddingFunction(), "test")
+    cached([f"{i}" for i in range(10)])
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda _: cached([f"{i}" for i in range(10)]), range(200)))
+    assert cached.hits == 200 * 10
+    assert cached.misses == 10
+
+def test_concurrent_callers_share_one_embedding():
+    import threading
+    import time
+
+    started = threading.Event()
+    calls = []
+
+    def slow_embedding_function(input):
+        calls.append(list(input))
+        started.set()
+        time.sleep(0.05)
+        return [[1.0, 2.0] for _ in input]
+
+    cached = CachedEmbeddingFunction(slow_embedding_function, "test")
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first = executor.submit(cached, ["a", "b"])
+        started.wait()
+        # "a" is being embedded by the first caller, only "c" is new
+        second = executor.submit(cached, ["a", "c"])
+        assert first.result() == [[1.0, 2.0], [1.0, 2.0]]
+        assert second.result() == [[1.0, 2.0], [1.0, 2.0]]
+    assert calls == [["a", "b"], ["c"]]
+    assert cached._pending == {}
+
+def test_failed_embedding_is_raised_to_waiting_callers():
+    import threading
+    import time
+
+    started = threading.Event()
+
+    def failing_embedding_function(input):
+        started.set()
+        time.sleep(0.05)
+        raise RuntimeError("model failed")
+
+    cached = CachedEmbeddingFunction(failing_embedding_function, "test")
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first = executor.submit(cached, ["a"])
+        started.wait()
+        second = executor.submit(cached, ["a"])
+        for future in [first, second]:
+            try:
+                future.result()
+                assert False, "expected the model error"
+            except RuntimeError as e:
+                assert str(e) == "model failed"
+    assert cached._pending == {}
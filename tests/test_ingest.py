@@ -0,0 +1,96 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip("tqdm")
+
+from pendo.dataloaders import ChunkedDoc, DocRecord
+from pendo.indexers import ChunkIndexer, registry
+from pendo.ingest import ingest
+from pendo.journal import IngestJournal
+
+
+class StubDataloader():
+    name = "primary"
+
+    def __init__(self):
+        self.fetched = []
+
+    async def retrieve_chunked_doc(self, doc):
+        doc_id = doc.id if isinstance(doc, DocRecord) else doc
+        self.fetched.append(doc_id)
+        return ChunkedDoc(doc_id, f"Title {doc_id}", "2024-01-01", [f"{doc_id} first", f"{doc_id} second"], metadata={})
+
+class SlowEmbeddingFunction():
+    """
+    Takes a while per batch, like the model, and records how many batches run at once
+    """
+
+    def __init__(self):
+        self.active = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, input):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(0.02)
+        with self.lock:
+            self.active -= 1
+        return [[float(len(text)), 1.0] for text in input]
+
+class RecordingIndexer():
+
+    def __init__(self, fail_on=None):
+        self.batches = []
+        self.fail_on = fail_on
+
+    async def index_docs(self, docs):
+        await asyncio.sleep(0.01)
+        if self.fail_on is not None and any(doc.id == self.fail_on for doc in docs):
+            raise ValueError(f"unable to index {self.fail_on}")
+        self.batches.append([doc.id for doc in docs])
+
+
+def test_several_embedding_batches_run_at_once(monkeypatch, collection):
+    embedding_function = SlowEmbeddingFunction()
+    monkeypatch.setattr(registry, "_EMBEDDING_FUNCTIONS", {"default": embedding_function})
+    monkeypatch.setattr(registry, "_EMBEDDING_EXECUTOR", ThreadPoolExecutor(max_workers=4))
+    indexer = ChunkIndexer("chunk", embedding_workers=4)
+    indexer._index = collection
+
+    # Default sizes: micro-batches of 16 docs hold far fewer chunks than the 256 of an embedding batch
+    doc_ids = [f"doc{i}" for i in range(128)]
+    asyncio.run(ingest(StubDataloader(), {"chunks": indexer}, doc_ids))
+
+    assert len(collection.entries) == 2 * len(doc_ids)
+    assert embedding_function.peak > 1
+
+def test_batches_are_journaled_and_skipped(tmp_path):
+    journal = IngestJournal(tmp_path / "primary.journal.jsonl")
+    asyncio.run(journal.record([("doc0", "2024-01-01", "summary"), ("doc0", "2024-01-01", "chunks"), ("doc1", "2024-01-01", "chunks")]))
+    summary, chunks = RecordingIndexer(), RecordingIndexer()
+    dataloader = StubDataloader()
+
+    records = [DocRecord(f"doc{i}", f"Title {i}", "2024-01-01") for i in range(40)]
+    asyncio.run(ingest(dataloader, {"summary": summary, "chunks": chunks}, records, batch_size=4, journal=journal))
+
+    # A doc done by every indexer is not even fetched, one done by some is only indexed by the others
+    assert "doc0" not in dataloader.fetched
+    assert sorted(doc for batch in summary.batches for doc in batch) == sorted(f"doc{i}" for i in range(1, 40))
+    assert sorted(doc for batch in chunks.batches for doc in batch) == sorted(f"doc{i}" for i in range(2, 40))
+    assert all(len(batch) <= 4 for batch in summary.batches)
+    assert len(journal) == 2 * 40
+
+def test_failed_batch_stops_ingestion(tmp_path):
+    journal = IngestJournal(tmp_path / "primary.journal.jsonl")
+    indexer = RecordingIndexer(fail_on="doc5")
+
+    with pytest.raises(ValueError, match="doc5"):
+        asyncio.run(asyncio.wait_for(ingest(StubDataloader(), {"summary": indexer}, [f"doc{i}" for i in range(400)], batch_size=4, journal=journal), timeout=10))
+    assert sum(len(batch) for batch in indexer.batches) < 400
+    assert not journal.is_done("doc5", "2024-01-01", "summary")
@@ -0,0 +1,71 @@
+import asyncio
+import json
+
+from pendo.journal import IngestJournal
+
+
+def test_records_survive_restart(tmp_path):
+    path = tmp_path / "primary.journal.jsonl"
+    journal = IngestJournal(path)
+    asyncio.run(journal.record([("a", "2024-01-01", "summary"), ("a", "2024-01-01", "chunks")]))
+
+    journal = IngestJournal(path)
+    assert len(journal) == 2
+    assert journal.is_done("a", "2024-01-01", "summary")
+    assert journal.is_done("a", "2024-01-01", "chunks")
+    assert not journal.is_done("a", "2024-01-01", "centroids")
+
+def test_edited_docs_are_not_done(tmp_path):
+    journal = IngestJournal(tmp_path / "primary.journal.jsonl")
+    asyncio.run(journal.record([("a", "2024-01-01", "summary")]))
+
+    assert not journal.is_done("a", "2024-02-01", "summary")
+
+def test_unrecorded_docs_without_edit_time_are_not_done(tmp_path):
+    journal = IngestJournal(tmp_path / "primary.journal.jsonl")
+    assert not journal.is_done("a", None, "summary")
+
+    asyncio.run(journal.record([("a", None, "summary")]))
+    assert journal.is_done("a", None, "summary")
+
+def test_torn_line_is_ignored_and_compacted(tmp_path):
+    path = tmp_path / "primary.journal.jsonl"
+    journal = IngestJournal(path)
+    asyncio.run(journal.record([("a", "1", "summary"), ("b", "1", "summary")]))
+    asyncio.run(journal.record([("a", "2", "summary")]))
+    with open(path, "a") as f:
+        f.write('{"doc_id": "c", "last_ed')
+
+    journal = IngestJournal(path)
+    assert len(journal) == 2
+    assert journal.is_done("a", "2", "summary")
+    assert not journal.is_done("a", "1", "summary")
+    assert not journal.is_done("c", "1", "summary")
+    # Superseded and torn entries are gone from the file
+    with open(path) as f:
+        entries = [json.loads(line) for line in f]
+    assert sorted((e["doc_id"], e["last_edited_time"]) for e in entries) == [("a", "2"), ("b", "1")]
+
+def test_concurrent_records_do_not_interleave(tmp_path):
+    path = tmp_path / "primary.journal.jsonl"
+    journal = IngestJournal(path)
+
+    async def record_all():
+        await asyncio.gather(*[
+            journal.record([(f"{i}-{j}", "1", f"indexer{i}") for j in range(50)])
+            for i in range(8)
+        ])
+    asyncio.run(record_all())
+
+    assert len(IngestJournal(path)) == 8 * 50
+    with open(path) as f:
+        assert len(f.readlines()) == 8 * 50
+
+def test_clear_removes_the_journal(tmp_path):
+    path = tmp_path / "primary.journal.jsonl"
+    journal = IngestJournal(path)
+    asyncio.run(journal.record([("a", "1", "summary")]))
+
+    journal.clear()
+    assert len(journal) == 0
+    assert not path.exists()
@@ -0,0 +1,28 @@
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip("notion_client")
+
+
+def _imported_modules(code):
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    return result.stdout.split()
+
+def test_packages_import_without_heavy_dependencies():
+    modules = _imported_modules(
+        "import sys, pendo.dataloaders, pendo.indexers, pendo.llms\n"
+        "print(' '.join(m for m in ['notion_client', 'chromadb', 'tiktoken', 'openai'] if m in sys.modules))"
+    )
+    assert modules == []
+
+def test_deferred_notion_import_resolves():
+    # The retry policy imports notion_client on the first failed request, which must not raise
+    modules = _imported_modules(
+        "import sys\n"
+        "from pendo.dataloaders import NotionDataloader\n"
+        "assert NotionDataloader._retry_policy(ValueError()) is None\n"
+        "print(' '.join(m for m in ['notion_client'] if m in sys.modules))"
+    )
+    assert modules == ["notion_client"]
@@ -0,0 +1,52 @@
+import logging
+
+import pytest
+
+pytest.importorskip("notion_client")
+
+from pendo.core import limits
+from pendo.dataloaders import NotionDataloader
+
+
+@pytest.fixture(autouse=True)
+def reset_limits(monkeypatch):
+    monkeypatch.setattr(limits, "_LIMITS", {})
+    monkeypatch.setattr(limits, "_SEMAPHORES", {})
+    monkeypatch.setattr(limits, "_SHARED", {})
+
+def _dataloader(name, **config):
+    config = {
+        "database_id": f"{name}-db",
+        "title_prop": "Title",
+        "relation_cache_on_disk": False,
+        "response_cache": False,
+        **config,
+    }
+    return NotionDataloader(name, config, tokenizer=None)
+
+
+def test_notion_dataloaders_share_the_global_scheduler():
+    limits.configure_limits({"notion": {"requests_per_second": 5, "burst": 2}})
+    first, second = _dataloader("first"), _dataloader("second")
+
+    assert first.scheduler is second.scheduler
+    assert first.shared_scheduler and second.shared_scheduler
+    assert first.scheduler.requests_per_second == 5
+    # The shared scheduler keeps no reference to the dataloader that happened to create it
+    assert first.scheduler.retry_policy is NotionDataloader._retry_policy
+
+def test_rate_limit_is_ignored_with_a_global_limit(caplog):
+    limits.configure_limits({"notion": {"requests_per_second": 5}})
+    with caplog.at_level(logging.WARNING):
+        dataloader = _dataloader("primary", rate_limit={"requests_per_second": 1})
+
+    assert dataloader.scheduler.requests_per_second == 5
+    assert "`rate_limit` is ignored" in caplog.text
+
+def test_rate_limit_applies_without_a_global_limit():
+    first = _dataloader("first", rate_limit={"requests_per_second": 1})
+    second = _dataloader("second")
+
+    assert not first.shared_scheduler
+    assert first.scheduler is not second.scheduler
+    assert first.scheduler.requests_per_second == 1
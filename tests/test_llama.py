@@ -0,0 +1,157 @@
+import asyncio
+import json
+
+import pytest
+
+web = pytest.importorskip("aiohttp.web")
+
+from pendo.llms import LlamaLlm, LlmScheduler, Message, MessageRole
+from pendo.llms.llama import LlamaServerError
+
+
+REPLY = {
+    "choices": [{"message": {"role": "assistant", "content": " Hello there. "}}],
+    "usage": {"completion_tokens": 3, "prompt_tokens": 7},
+}
+
+class StubServer():
+    """
+    A llama.cpp server answering /v1/chat/completions with the queued (status, body) responses,
+    then with REPLY
+    """
+
+    def __init__(self, responses=None):
+        self.responses = list(responses or [])
+        self.requests = []
+
+    async def handle(self, request):
+        payload = await request.json()
+        self.requests.append(payload)
+        if len(self.responses) > 0:
+            status, body = self.responses.pop(0)
+            return web.Response(status=status, text=body)
+        if not payload.get("stream", False):
+            return web.json_response(REPLY)
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for content in ["Hel", "lo", ""]:
+            await response.write(f"data: {json.dumps({'choices': [{'delta': {'content': content}}]})}\n\n".encode("utf-8"))
+        await response.write(f"data: {json.dumps({'choices': [], 'usage': {'completion_tokens': 2, 'prompt_tokens': 5}})}\n\n".encode("utf-8"))
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    async def __aexit__(self, *args):
+        await self.runner.cleanup()
+
+
+MESSAGES = [Message(MessageRole.USER, "Hi")]
+
+def test_chat_completion_async():
+    async def run():
+        async with StubServer() as server:
+            llm = LlamaLlm(server.url, max_tokens=64)
+            try:
+                reply, usage = await llm.chat_completion_async(MESSAGES)
+            finally:
+                await llm.close()
+            assert llm._session.closed
+            return server, reply, usage
+
+    server, reply, usage = asyncio.run(run())
+    assert reply.content == "Hello there."
+    assert (usage.completion_tokens, usage.prompt_tokens) == (3, 7)
+    assert server.requests[0]["messages"] == [{"role": "user", "content": "Hi"}]
+    assert server.requests[0]["max_tokens"] == 64
+
+def test_chat_completion_sync():
+    async def run():
+        async with StubServer() as server:
+            llm = LlamaLlm(server.url)
+            try:
+                # The blocking client must not hold up the loop serving the stub
+                return await asyncio.get_running_loop().run_in_executor(None, llm.chat_completion, MESSAGES)
+            finally:
+                await llm.close()
+
+    reply, usage = asyncio.run(run())
+    assert reply.content == "Hello there."
+    assert usage.total_tokens == 10
+
+def test_chat_completion_stream():
+    async def run():
+        async with StubServer() as server:
+            llm = LlamaLlm(server.url)
+            try:
+                stream = await llm.chat_completion_stream_async(MESSAGES)
+                deltas = [delta async for delta in stream]
+            finally:
+                await llm.close()
+            return server, stream, deltas
+
+    server, stream, deltas = asyncio.run(run())
+    assert deltas == ["Hel", "lo"]
+    assert stream.reply_message.content == "Hello"
+    assert (stream.usage.completion_tokens, stream.usage.prompt_tokens) == (2, 5)
+    assert server.requests[0]["stream"] is True
+
+def test_errors_include_the_response_body():
+    async def run():
+        async with StubServer([(400, "context window exceeded"), (400, "bad grammar")]) as server:
+            llm = LlamaLlm(server.url)
+            try:
+                with pytest.raises(LlamaServerError) as error:
+                    await llm.chat_completion_async(MESSAGES)
+                with pytest.raises(LlamaServerError) as stream_error:
+                    await llm.chat_completion_stream_async(MESSAGES)
+            finally:
+                await llm.close()
+            return error.value, stream_error.value
+
+    error, stream_error = asyncio.run(run())
+    assert error.status == 400
+    assert "context window exceeded" in str(error)
+    assert stream_error.body == "bad grammar"
+
+def test_server_errors_are_retried():
+    async def run():
+        async with StubServer([(503, "loading model")]) as server:
+            llm = LlamaLlm(server.url, scheduler=LlmScheduler(base_backoff=0.01))
+            # Skip the tokenizer, the estimate only orders requests
+            llm._count_prompt_tokens = lambda messages: 10
+            try:
+                reply, _ = await llm.chat_completion_async(MESSAGES)
+            finally:
+                await llm.close()
+            return server, llm, reply
+
+    server, llm, reply = asyncio.run(run())
+    assert reply.content == "Hello there."
+    assert len(server.requests) == 2
+    assert llm.scheduler.stats.retries == 1
+
+def test_close_llms_closes_every_session(monkeypatch):
+    import pendo.llms as llms
+    monkeypatch.setattr(llms, "REGISERED_LLM", {"local": {"type": "llama", "params": {"llama_cpp_server_url": "http://127.0.0.1:1"}}})
+    monkeypatch.setattr(llms, "REGISTERED_SCHEDULERS", {})
+    monkeypatch.setattr(llms, "CREATED_LLMS", [])
+
+    async def run():
+        created = [llms.get_llm("local"), llms.get_llm("local")]
+        for llm in created:
+            await llm._get_session()
+        await llms.close_llms()
+        return created
+
+    assert all(llm._session.closed for llm in asyncio.run(run()))
+    assert llms.CREATED_LLMS == []
@@ -0,0 +1,81 @@
+import asyncio
+import time
+from datetime import timedelta
+
+from pendo.llms import BaseLlm, LlmResponseCache, LlmUsage, Message, MessageRole
+
+
+MESSAGES = [Message(MessageRole.USER, "Hi")]
+
+def _reply(content="Hello"):
+    return Message(MessageRole.ASSISTANT, content)
+
+
+def test_keys_ignore_timestamps_but_not_params():
+    later = [Message(MessageRole.USER, "Hi", timestamp="2030-01-01T00:00:00")]
+    key = LlmResponseCache.make_key("gpt", MESSAGES, {"temperature": 0})
+
+    assert LlmResponseCache.make_key("gpt", later, {"temperature": 0}) == key
+    assert LlmResponseCache.make_key("gpt", MESSAGES, {"temperature": 1}) != key
+    assert LlmResponseCache.make_key("llama", MESSAGES, {"temperature": 0}) != key
+
+def test_entries_survive_restart(tmp_path):
+    path = tmp_path / "llm.sqlite3"
+    LlmResponseCache(path).put("key", _reply(), 3, 7)
+
+    cached = LlmResponseCache(path).get("key")
+    assert cached["message"].content == "Hello"
+    assert cached["message"].role == MessageRole.ASSISTANT
+    assert (cached["completion_tokens"], cached["prompt_tokens"]) == (3, 7)
+    assert LlmResponseCache(path).get("other") is None
+
+def test_entries_expire(tmp_path, monkeypatch):
+    cache = LlmResponseCache(tmp_path / "llm.sqlite3", ttl=60)
+    cache.put("key", _reply(), 3, 7)
+
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    assert cache.get("key") is None
+    assert cache._entries == 0
+
+def test_least_recently_used_entries_are_evicted(tmp_path, monkeypatch):
+    cache = LlmResponseCache(tmp_path / "llm.sqlite3", max_entries=10)
+    now = time.time()
+    for i in range(10):
+        monkeypatch.setattr(time, "time", lambda i=i: now + i)
+        cache.put(f"key{i}", _reply(), 1, 1)
+    monkeypatch.setattr(time, "time", lambda: now + 10)
+    cache.get("key0")
+    monkeypatch.setattr(time, "time", lambda: now + 11)
+    cache.put("key10", _reply(), 1, 1)
+
+    assert cache._entries == 9
+    assert cache.get("key0") is not None
+    assert cache.get("key1") is None
+    assert cache.get("key10") is not None
+
+
+class CountingLlm(BaseLlm):
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.calls = 0
+
+    async def _chat_completion_async(self, messages, **kwargs):
+        self.calls += 1
+        return _reply(), LlmUsage(3, 7, timedelta(seconds=1))
+
+def test_async_completions_are_cached(tmp_path):
+    llm = CountingLlm(cache=LlmResponseCache(tmp_path / "llm.sqlite3"))
+
+    async def run():
+        first = await llm.chat_completion_async(MESSAGES, temperature=0)
+        second = await llm.chat_completion_async(MESSAGES, temperature=0)
+        return first, second
+
+    (first, first_usage), (second, second_usage) = asyncio.run(run())
+    assert llm.calls == 1
+    assert second.content == first.content
+    assert first_usage.cache_misses == 1
+    assert second_usage.cache_hits == 1
+    assert (llm.total_usage.cache_hits, llm.total_usage.cache_misses) == (1, 1)
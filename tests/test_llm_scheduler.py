@@ -0,0 +1,166 @@
+import asyncio
+
+import pytest
+
+from pendo.llms import LlmScheduler
+from pendo.llms.base import BaseLlm, StreamedChatCompletion
+
+
+def _no_retry(e):
+    return None
+
+async def _run_in_order(scheduler, sizes, hold_first=0.05):
+    # Occupy the only slot so the waiters queue up, then record the order they are served in
+    served = []
+    blocker = asyncio.ensure_future(scheduler.run(lambda: asyncio.sleep(hold_first), 1, _no_retry))
+    await asyncio.sleep(0)
+
+    async def request(size):
+        served.append(size)
+    await asyncio.gather(blocker, *[scheduler.run(lambda size=size: request(size), size, _no_retry) for size in sizes])
+    return served
+
+
+def test_smallest_request_first():
+    scheduler = LlmScheduler(max_concurrency=1)
+    assert asyncio.run(_run_in_order(scheduler, [300, 10, 200, 20])) == [10, 20, 200, 300]
+
+def test_long_waiting_request_is_not_bypassed():
+    scheduler = LlmScheduler(max_concurrency=1, max_wait=0.05)
+
+    async def run():
+        served = []
+        chained = []
+
+        async def small():
+            served.append(1)
+            # Every small request queues the next one, so a small one is always waiting
+            if len(chained) < 30:
+                chained.append(asyncio.ensure_future(scheduler.run(small, 1, _no_retry)))
+            await asyncio.sleep(0.01)
+
+        first = asyncio.ensure_future(scheduler.run(small, 1, _no_retry))
+        await asyncio.sleep(0)
+
+        async def large():
+            served.append(1000)
+        await scheduler.run(large, 1000, _no_retry)
+        await first
+        while len(chained) < 30 or not all(task.done() for task in chained):
+            await asyncio.sleep(0.01)
+        return served
+
+    served = asyncio.run(run())
+    assert len(served) == 32
+    assert served.index(1000) < 15
+
+def test_retries_until_success():
+    scheduler = LlmScheduler(base_backoff=0.01)
+    attempts = []
+
+    async def request():
+        attempts.append(None)
+        if len(attempts) < 3:
+            raise ConnectionError()
+        return "ok"
+
+    assert asyncio.run(scheduler.run(request, 10, lambda e: (False, None))) == "ok"
+    assert scheduler.stats.retries == 2
+    assert scheduler.stats.requests == 3
+
+def test_throttles_wait_for_retry_after():
+    scheduler = LlmScheduler()
+    attempts = []
+
+    async def request():
+        attempts.append(asyncio.get_running_loop().time())
+        if len(attempts) == 1:
+            raise ConnectionError()
+        return "ok"
+
+    asyncio.run(scheduler.run(request, 10, lambda e: (True, 0.05)))
+    assert attempts[1] - attempts[0] >= 0.05
+    assert scheduler.stats.throttles == 1
+
+def test_failures_are_raised():
+    scheduler = LlmScheduler()
+
+    async def request():
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        asyncio.run(scheduler.run(request, 10, _no_retry))
+    assert scheduler.stats.failures == 1
+    assert scheduler._active == 0
+
+def test_settle_corrects_the_token_budget():
+    scheduler = LlmScheduler(tokens_per_minute=1000)
+
+    async def run():
+        await scheduler.run(lambda: asyncio.sleep(0), 100, _no_retry)
+        scheduler.settle(100, 400)
+    asyncio.run(run())
+    assert scheduler._tokens.level == pytest.approx(600, abs=1)
+
+
+class StubStream(StreamedChatCompletion):
+
+    def __init__(self, deltas, **kwargs):
+        super().__init__(**kwargs)
+        self.deltas = deltas
+
+    async def generate(self):
+        for delta in self.deltas:
+            await asyncio.sleep(0.01)
+            yield delta
+        self.usage = StubLlm.USAGE
+
+class StubLlm(BaseLlm):
+    USAGE = None
+
+    def _count_prompt_tokens(self, messages):
+        return 100
+
+    async def _chat_completion_stream_async(self, messages, **kwargs):
+        return StubStream(["a", "b", "c"])
+
+def _stub_llm(scheduler):
+    from datetime import timedelta
+    from pendo.llms import LlmUsage
+    StubLlm.USAGE = LlmUsage(300, 100, timedelta(0))
+    return StubLlm(scheduler=scheduler)
+
+
+def test_stream_holds_its_slot_until_consumed():
+    scheduler = LlmScheduler(max_concurrency=1, tokens_per_minute=10000, expected_completion_tokens=100)
+    llm = _stub_llm(scheduler)
+
+    async def run():
+        stream = await llm.chat_completion_stream_async([])
+        assert scheduler._active == 1
+        other = asyncio.ensure_future(scheduler.run(lambda: asyncio.sleep(0), 1, _no_retry))
+        await asyncio.sleep(0.02)
+        # The next request waits for the stream, not just for the request that opened it
+        assert not other.done()
+        assert [delta async for delta in stream] == ["a", "b", "c"]
+        await other
+        return stream
+
+    asyncio.run(run())
+    assert scheduler._active == 0
+    # 200 tokens estimated, 400 used, and 1 for the other request, plus what refilled meanwhile
+    assert scheduler._tokens.level == pytest.approx(10000 - 401, abs=30)
+
+def test_stream_closed_early_gives_back_its_slot():
+    scheduler = LlmScheduler(max_concurrency=1)
+    llm = _stub_llm(scheduler)
+
+    async def run():
+        stream = await llm.chat_completion_stream_async([])
+        deltas = stream.__aiter__()
+        assert await deltas.__anext__() == "a"
+        await deltas.aclose()
+        await asyncio.wait_for(scheduler.run(lambda: asyncio.sleep(0), 1, _no_retry), timeout=1)
+
+    asyncio.run(run())
+    assert scheduler._active == 0
@@ -0,0 +1,45 @@
+import asyncio
+import sys
+
+import pytest
+
+pytest.importorskip("tqdm")
+
+import pendo.main as main
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = []
+
+    async def daemon_running(*args):
+        return True
+    async def sync(config):
+        calls.append("sync")
+    async def interactive(agent):
+        calls.append("interactive")
+
+    monkeypatch.setattr(main, "is_daemon_running", daemon_running)
+    monkeypatch.setattr(main, "setup", lambda: {})
+    monkeypatch.setattr(main, "sync", sync)
+    monkeypatch.setattr(main, "build_agent", lambda config: None)
+    monkeypatch.setattr(main, "interactive", interactive)
+    return calls
+
+def test_local_prompt_does_not_sync_next_to_a_daemon(calls, monkeypatch):
+    monkeypatch.setattr(sys, "argv", ["pendo", "--local"])
+    asyncio.run(main.main())
+    assert calls == ["interactive"]
+
+def test_local_sync_is_refused_next_to_a_daemon(calls, monkeypatch):
+    monkeypatch.setattr(sys, "argv", ["pendo", "--local", "--sync"])
+    asyncio.run(main.main())
+    assert calls == []
+
+def test_local_prompt_syncs_without_a_daemon(calls, monkeypatch):
+    async def daemon_running(*args):
+        return False
+    monkeypatch.setattr(main, "is_daemon_running", daemon_running)
+    monkeypatch.setattr(sys, "argv", ["pendo", "--local"])
+    asyncio.run(main.main())
+    assert calls == ["sync", "interactive"]
@@ -0,0 +1,114 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("notion_client")
+
+from pendo.core import limits
+from pendo.dataloaders import NotionDataloader
+
+
+class StubBlocks():
+    """
+    blocks.children.list over a tree of {block_id: [blocks]}, `page_size` blocks per response
+    """
+
+    def __init__(self, tree, page_size=2):
+        self.tree = tree
+        self.page_size = page_size
+        self.requests = []
+
+    async def list(self, block_id, start_cursor=None, page_size=100):
+        self.requests.append((block_id, start_cursor))
+        await asyncio.sleep(0)
+        start = int(start_cursor) if start_cursor is not None else 0
+        end = start + self.page_size
+        blocks = self.tree.get(block_id, [])
+        has_more = end < len(blocks)
+        return {"results": blocks[start:end], "has_more": has_more, "next_cursor": str(end) if has_more else None}
+
+class StubNotionClient():
+
+    def __init__(self, tree, page_size=2):
+        self.blocks = type("Blocks", (), {})()
+        self.blocks.children = StubBlocks(tree, page_size)
+
+@pytest.fixture(autouse=True)
+def reset_limits(monkeypatch):
+    monkeypatch.setattr(limits, "_LIMITS", {})
+    monkeypatch.setattr(limits, "_SHARED", {})
+
+def _dataloader(tree, page_size=2):
+    dataloader = NotionDataloader("primary", {
+        "database_id": "db",
+        "title_prop": "Title",
+        "relation_cache_on_disk": False,
+        "response_cache": False,
+        "rate_limit": {"requests_per_second": 1000, "burst": 1000},
+    }, tokenizer=None)
+    dataloader.notion_client = StubNotionClient(tree, page_size)
+    return dataloader
+
+def _block(id, type="paragraph", has_children=False, **kwargs):
+    return {"id": id, "type": type, "has_children": has_children, **kwargs}
+
+def _walk(dataloader, page_id="page"):
+    async def run():
+        return [block["id"] for block in await dataloader._retrieve_block_tree(page_id)]
+    return asyncio.run(run())
+
+
+def test_tables_child_pages_and_databases_are_not_walked():
+    tree = {
+        "page": [
+            _block("table", "table", True),
+            _block("subpage", "child_page", True),
+            _block("database", "child_database", True),
+            _block("after"),
+        ],
+        "table": [_block(f"row{i}", "table_row") for i in range(10)],
+        "subpage": [_block("other page")],
+        "database": [_block("other row")],
+    }
+    dataloader = _dataloader(tree)
+
+    assert _walk(dataloader) == ["table", "subpage", "database", "after"]
+    assert sorted({block_id for block_id, _ in dataloader.notion_client.blocks.children.requests}) == ["page"]
+
+def test_children_are_paginated():
+    dataloader = _dataloader({"page": [_block(f"b{i}") for i in range(5)]}, page_size=2)
+
+    assert _walk(dataloader) == ["b0", "b1", "b2", "b3", "b4"]
+    assert dataloader.notion_client.blocks.children.requests == [("page", None), ("page", "2"), ("page", "4")]
+
+def test_nested_blocks_are_returned_in_document_order():
+    tree = {
+        "page": [_block("a", has_children=True), _block("b"), _block("c", "toggle", True)],
+        "a": [_block("a1", "bulleted_list_item", True), _block("a2")],
+        "a1": [_block("a1x"), _block("a1y"), _block("a1z")],
+        "c": [_block("c1")],
+    }
+    dataloader = _dataloader(tree, page_size=2)
+
+    assert _walk(dataloader) == ["a", "a1", "a1x", "a1y", "a1z", "a2", "b", "c", "c1"]
+    # Walked one level at a time
+    requested = [block_id for block_id, cursor in dataloader.notion_client.blocks.children.requests if cursor is None]
+    assert requested == ["page", "a", "c", "a1"]
+
+def test_synced_blocks_are_read_from_the_original():
+    synced_from = lambda block_id: {"synced_block": {"synced_from": {"block_id": block_id}}}
+    tree = {
+        "page": [
+            _block("original", "synced_block", True, synced_block={"synced_from": None}),
+            _block("copy", "synced_block", True, **synced_from("original")),
+            _block("remote copy", "synced_block", True, **synced_from("elsewhere")),
+        ],
+        "original": [_block("shared")],
+        "elsewhere": [_block("remote")],
+    }
+    dataloader = _dataloader(tree)
+
+    assert _walk(dataloader) == ["original", "shared", "copy", "shared", "remote copy", "remote"]
+    requested = [block_id for block_id, _ in dataloader.notion_client.blocks.children.requests]
+    assert "copy" not in requested and "remote copy" not in requested
+    assert sorted(requested) == ["elsewhere", "original", "original", "page", "page"]
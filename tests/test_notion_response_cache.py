@@ -0,0 +1,77 @@
+import asyncio
+import os
+import time
+
+from pendo.dataloaders.cache import NotionResponseCache
+
+
+def _page(page_id, last_edited_time="2024-01-01"):
+    return {"id": page_id, "last_edited_time": last_edited_time, "properties": {}}
+
+def _age(path, seconds):
+    used = time.time() - seconds
+    os.utime(path, (used, used))
+
+
+def test_pages_and_blocks_round_trip(tmp_path):
+    cache = NotionResponseCache(tmp_path)
+
+    async def run():
+        await cache.put_pages([_page("a"), _page("b")])
+        await cache.put_blocks("a", "2024-01-01", [{"id": "block"}])
+        return (
+            await cache.get_page("a"),
+            await cache.get_page("missing"),
+            sorted(page["id"] for page in await cache.load_pages()),
+            await cache.get_blocks("a", "2024-01-01"),
+            await cache.get_blocks("a", "2024-02-01"),
+            await cache.get_blocks("b"),
+        )
+
+    page, missing, page_ids, blocks, stale_blocks, no_blocks = asyncio.run(run())
+    assert page == _page("a")
+    assert missing is None
+    assert page_ids == ["a", "b"]
+    assert blocks == [{"id": "block"}]
+    assert stale_blocks is None
+    assert no_blocks is None
+
+def test_old_entries_are_ignored_and_evicted(tmp_path):
+    cache = NotionResponseCache(tmp_path, max_age=3600)
+
+    async def run():
+        await cache.put_pages([_page("old"), _page("new")])
+        await cache.put_blocks("old", "2024-01-01", [])
+        _age(tmp_path / "pages" / "old.json", 7200)
+        _age(tmp_path / "blocks" / "old.json", 7200)
+        assert await cache.get_page("old") is None
+        assert await cache.get_blocks("old") is None
+        await cache.evict()
+
+    asyncio.run(run())
+    assert sorted(path.name for path in (tmp_path / "pages").iterdir()) == ["new.json"]
+    assert list((tmp_path / "blocks").iterdir()) == []
+
+def test_least_recently_used_pages_are_evicted(tmp_path):
+    cache = NotionResponseCache(tmp_path, max_pages=2)
+
+    async def run():
+        await cache.put_pages([_page("a"), _page("b"), _page("c")])
+        await cache.put_blocks("a", "2024-01-01", [])
+        for i, page_id in enumerate(["a", "b", "c"]):
+            _age(tmp_path / "pages" / f"{page_id}.json", 300 - i * 100)
+        _age(tmp_path / "blocks" / "a.json", 300)
+        # Reading a page counts as using it
+        await cache.get_page("a")
+        await cache.evict()
+
+    asyncio.run(run())
+    assert sorted(path.name for path in (tmp_path / "pages").iterdir()) == ["a.json", "c.json"]
+    assert sorted(path.name for path in (tmp_path / "blocks").iterdir()) == ["a.json"]
+
+def test_unreadable_entries_are_ignored(tmp_path):
+    cache = NotionResponseCache(tmp_path)
+    (tmp_path / "pages" / "a.json").write_text("{torn")
+
+    assert asyncio.run(cache.get_page("a")) is None
+    assert asyncio.run(cache.load_pages()) == []
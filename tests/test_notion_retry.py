@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+
+httpx = pytest.importorskip("httpx")
+notion_client = pytest.importorskip("notion_client")
+
+from notion_client import APIResponseError
+from notion_client.errors import HTTPResponseError, RequestTimeoutError
+
+from pendo.dataloaders import NotionDataloader
+from pendo.dataloaders.scheduler import RequestScheduler
+
+
+def _response(status, headers=None):
+    return httpx.Response(status, headers=headers, request=httpx.Request("POST", "https://api.notion.com/v1/databases/x/query"))
+
+def _retry_policy(e):
+    return NotionDataloader._retry_policy(e)
+
+
+def test_rate_limited_uses_retry_after():
+    e = APIResponseError(_response(429, {"retry-after": "2"}), "Rate limited", "rate_limited")
+    assert _retry_policy(e) == (True, 2.0)
+
+def test_rate_limited_without_retry_after():
+    e = APIResponseError(_response(429), "Rate limited", "rate_limited")
+    assert _retry_policy(e) == (True, None)
+
+def test_server_errors_are_retried():
+    assert _retry_policy(HTTPResponseError(_response(502))) == (False, None)
+    assert _retry_policy(APIResponseError(_response(503), "Unavailable", "service_unavailable")) == (False, None)
+
+def test_timeouts_and_transport_errors_are_retried():
+    assert _retry_policy(RequestTimeoutError()) == (False, None)
+    assert _retry_policy(httpx.ConnectError("refused")) == (False, None)
+
+def test_client_errors_are_not_retried():
+    assert _retry_policy(APIResponseError(_response(400), "Invalid", "validation_error")) is None
+    assert _retry_policy(ValueError("unrelated")) is None
+
+
+def test_scheduler_retries_notion_errors():
+    scheduler = RequestScheduler(requests_per_second=1000, burst=10, base_backoff=0.01, retry_policy=_retry_policy)
+    calls = []
+
+    async def request():
+        calls.append(None)
+        if len(calls) == 1:
+            raise APIResponseError(_response(429, {"retry-after": "0.01"}), "Rate limited", "rate_limited")
+        if len(calls) == 2:
+            raise RequestTimeoutError()
+        return "ok"
+
+    assert asyncio.run(scheduler.run(request)) == "ok"
+    assert len(calls) == 3
+    assert scheduler.stats.retries == 2
+    assert scheduler.stats.throttles == 1
+    assert scheduler.stats.failures == 0
+
+def test_scheduler_gives_up_on_client_errors():
+    scheduler = RequestScheduler(requests_per_second=1000, burst=10, retry_policy=_retry_policy)
+
+    async def request():
+        raise APIResponseError(_response(404), "Not found", "object_not_found")
+
+    with pytest.raises(APIResponseError):
+        asyncio.run(scheduler.run(request))
+    assert scheduler.stats.retries == 0
+    assert scheduler.stats.failures == 1
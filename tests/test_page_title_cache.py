@@ -0,0 +1,47 @@
+import time
+
+from pendo.dataloaders.cache import PageTitleCache
+
+
+def test_edited_pages_are_dropped():
+    cache = PageTitleCache()
+    cache.put("a", "Alpha", "2024-01-01")
+
+    cache.validate("a", "2024-01-01")
+    assert cache.get("a") == "Alpha"
+    cache.validate("a", "2024-02-01")
+    assert cache.get("a") is None
+
+def test_entries_expire_after_ttl(monkeypatch):
+    cache = PageTitleCache(ttl=60)
+    cache.put("a", "Alpha", "2024-01-01")
+
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    assert cache.get("a") is None
+
+def test_least_recently_used_entries_are_evicted():
+    cache = PageTitleCache(max_size=2)
+    cache.put("a", "Alpha", "1")
+    cache.put("b", "Beta", "1")
+    cache.get("a")
+    cache.put("c", "Gamma", "1")
+
+    assert cache.get("a") == "Alpha"
+    assert cache.get("b") is None
+    assert cache.get("c") == "Gamma"
+
+def test_entries_persist_to_disk(tmp_path):
+    path = tmp_path / "primary_titles.json"
+    cache = PageTitleCache(path=path)
+    cache.put("a", "Alpha", "1")
+    cache.save()
+
+    assert PageTitleCache(path=path).get("a") == "Alpha"
+
+def test_unreadable_file_is_ignored(tmp_path):
+    path = tmp_path / "primary_titles.json"
+    path.write_text("{not json")
+
+    cache = PageTitleCache(path=path)
+    assert cache.get("a") is None
@@ -0,0 +1,180 @@
+import asyncio
+import itertools
+
+import pytest
+
+from pendo.agents import PerplexitySearchAgent
+from pendo.llms import Message, MessageDelta, MessageRole
+from pendo.llms.base import StreamedChatCompletion
+
+
+def _agent(**kwargs):
+    return PerplexitySearchAgent(None, None, None, None, **kwargs)
+
+def _candidates(rows):
+    # rows: one list of (doc_id, distance) per query, in rank order
+    return {
+        "ids": [[doc_id for doc_id, _ in row] for row in rows],
+        "distances": [[distance for _, distance in row] for row in rows],
+        "metadatas": [[{"title": doc_id} for doc_id, _ in row] for row in rows],
+    }
+
+def _per_query_rrf(candidates):
+    # The fusion as it was before all queries went to the index in one call
+    docs = []
+    for ids, distances, metadatas in zip(candidates["ids"], candidates["distances"], candidates["metadatas"]):
+        docs.append([{"id": doc_id, "score": 1.0/idx, "distance": distance, "metadata": metadata} for idx, doc_id, distance, metadata in zip(itertools.count(1), ids, distances, metadatas)])
+
+    doc_candidates = {}
+    for cand in itertools.chain(*docs):
+        if cand["id"] not in doc_candidates:
+            doc_candidates[cand["id"]] = dict(cand)
+        else:
+            doc_candidates[cand["id"]]["score"] += cand["score"]
+            doc_candidates[cand["id"]]["distance"] = min(doc_candidates[cand["id"]]["distance"], cand["distance"])
+    doc_candidates = list(doc_candidates.values())
+    doc_candidates.sort(key=lambda x: x["score"], reverse=True)
+    return doc_candidates
+
+
+@pytest.mark.parametrize("rows", [
+    [[("a", 0.1), ("b", 0.2), ("c", 0.3)]],
+    [[("a", 0.1), ("b", 0.2), ("c", 0.3)], [("c", 0.05), ("a", 0.4), ("d", 0.5)]],
+    # Ties in score keep the doc that appeared first in front
+    [[("z", 0.1), ("y", 0.2)], [("y", 0.3), ("z", 0.4)], [("x", 0.2), ("w", 0.6)]],
+    [[("b", 0.3), ("a", 0.1)], [("a", 0.2), ("b", 0.2)], [], [("c", 0.9)]],
+])
+def test_fusion_matches_per_query_rrf(rows):
+    candidates = _candidates(rows)
+    fused = _agent()._fuse_candidates(candidates)
+    expected = _per_query_rrf(candidates)
+    assert [doc["id"] for doc in fused] == [doc["id"] for doc in expected]
+    assert [doc["score"] for doc in fused] == pytest.approx([doc["score"] for doc in expected])
+    assert [doc["distance"] for doc in fused] == [doc["distance"] for doc in expected]
+    assert [doc["metadata"] for doc in fused] == [doc["metadata"] for doc in expected]
+
+def test_ties_are_broken_by_first_appearance():
+    fused = _agent()._fuse_candidates(_candidates([[("z", 0.1), ("y", 0.2)], [("y", 0.3), ("z", 0.4)]]))
+    assert [doc["id"] for doc in fused] == ["z", "y"]
+    assert fused[0]["score"] == fused[1]["score"] == pytest.approx(1.5)
+    assert [doc["distance"] for doc in fused] == [0.1, 0.2]
+
+def test_fusion_of_empty_results():
+    assert _agent()._fuse_candidates(_candidates([])) == []
+    assert _agent()._fuse_candidates(_candidates([[], []])) == []
+
+
+class StubSummaryIndex():
+
+    def __init__(self, results):
+        self.results = results
+        self.requests = []
+
+    def query(self, query_texts, n_results):
+        self.requests.append(list(query_texts))
+        rows = [self.results.get(text, [])[:n_results] for text in query_texts]
+        return {
+            "ids": [[doc_id for doc_id, _ in row] for row in rows],
+            "distances": [[distance for _, distance in row] for row in rows],
+            "metadatas": [[{"title": doc_id} for doc_id, _ in row] for row in rows],
+        }
+
+class StubChunkIndex():
+
+    def __init__(self, chunks):
+        # (doc_id, chunk_id, text, distance)
+        self.chunks = chunks
+        self.requests = []
+
+    def query(self, query_texts, where, n_results):
+        doc_ids = set(where["doc_id"]["$in"])
+        self.requests.append(doc_ids)
+        rows = sorted([chunk for chunk in self.chunks if chunk[0] in doc_ids], key=lambda chunk: chunk[3])[:n_results]
+        return {
+            "ids": [[f"{doc_id}_{chunk_id}" for doc_id, chunk_id, _, _ in rows]],
+            "distances": [[distance for _, _, _, distance in rows]],
+            "metadatas": [[{"doc_id": doc_id, "chunk_id": chunk_id, "num_tokens": 1} for doc_id, chunk_id, _, _ in rows]],
+            "documents": [[text for _, _, text, _ in rows]],
+        }
+
+class StubStream(StreamedChatCompletion):
+
+    async def generate(self):
+        for delta in ["An", "swer"]:
+            yield delta
+        self.reply_message = Message(MessageRole.ASSISTANT, "Answer")
+
+class StubLlm():
+
+    def __init__(self, chunk_index, expansion="q1; q2"):
+        self.chunk_index = chunk_index
+        self.expansion = expansion
+        self.expansion_cancelled = False
+        self.chunk_requests_during_expansion = None
+        self.messages = None
+
+    async def chat_completion_async(self, messages, **kwargs):
+        try:
+            if self.expansion is None:
+                await asyncio.Event().wait()
+            # Let the speculative retrieval catch up before expanding
+            for _ in range(1000):
+                if len(self.chunk_index.requests) > 0:
+                    break
+                await asyncio.sleep(0.001)
+        except asyncio.CancelledError:
+            self.expansion_cancelled = True
+            raise
+        self.chunk_requests_during_expansion = list(self.chunk_index.requests)
+        return Message(MessageRole.ASSISTANT, self.expansion), None
+
+    async def chat_completion_stream_async(self, messages, **kwargs):
+        self.messages = messages
+        return StubStream()
+
+CHUNKS = [("a", 1, "alpha one", 0.1), ("a", 2, "alpha two", 0.3), ("b", 1, "beta", 0.2), ("c", 1, "gamma", 0.15)]
+
+def _run_agent(summary_results, expansion, **kwargs):
+    summary_index = StubSummaryIndex(summary_results)
+    chunk_index = StubChunkIndex(CHUNKS)
+    llm = StubLlm(chunk_index, expansion)
+    agent = PerplexitySearchAgent(llm, None, summary_index, chunk_index, shortlisting_threshold=1.0, **kwargs)
+
+    async def run():
+        return [message for message, usage in [result async for result in agent.run("question")]]
+    try:
+        messages = asyncio.run(asyncio.wait_for(run(), timeout=10))
+    finally:
+        agent.close()
+    return messages, llm, summary_index, chunk_index
+
+
+def test_raw_question_is_searched_while_the_query_is_expanded():
+    summary_results = {"question": [("a", 0.3), ("b", 0.4)], "q1": [("c", 0.2), ("a", 0.5)], "q2": [("b", 0.35)]}
+    messages, llm, summary_index, chunk_index = _run_agent(summary_results, "q1; q2", skip_expansion_distance=0.1)
+
+    assert summary_index.requests == [["question"], ["q1", "q2"]]
+    # Snippets of the raw shortlist are fetched before the expansion returns, the rest afterwards
+    assert llm.chunk_requests_during_expansion == [{"a", "b"}]
+    assert chunk_index.requests == [{"a", "b"}, {"c"}]
+
+    assert messages[0].content.startswith("Expanding your queries")
+    assert messages[1].content.split("\n")[1:4] == ["1.50 \t a", "1.50 \t b", "1.00 \t c"]
+    assert "".join(message.content for message in messages if isinstance(message, MessageDelta)) == "Answer"
+    assert messages[-1].content == "Answer"
+    context = llm.messages[0].content
+    assert "document 1\n title a\n alpha one alpha two" in context
+    assert "document 2\n title b\n beta" in context
+    assert "document 3\n title c\n gamma" in context
+
+def test_expansion_is_skipped_for_close_matches():
+    summary_results = {"question": [("a", 0.05), ("b", 0.4)]}
+    messages, llm, summary_index, chunk_index = _run_agent(summary_results, None, skip_expansion_distance=0.1)
+
+    assert llm.expansion_cancelled
+    assert summary_index.requests == [["question"]]
+    assert chunk_index.requests == [{"a", "b"}]
+    assert messages[0].content.startswith("Found close matches")
+    assert messages[1].content.split("\n")[1:3] == ["1.00 \t a", "0.50 \t b"]
+    assert messages[-1].content == "Answer"
+    assert "document 2\n title b\n beta" in llm.messages[0].content
@@ -0,0 +1,93 @@
+import asyncio
+import time
+
+import pytest
+
+from pendo.dataloaders.scheduler import RequestScheduler
+
+
+def test_requests_are_paced_by_the_token_bucket():
+    scheduler = RequestScheduler(requests_per_second=50, burst=2, max_concurrency=10)
+    started = []
+
+    async def request():
+        started.append(time.monotonic())
+
+    async def run():
+        await asyncio.gather(*[scheduler.run(request) for _ in range(7)])
+    asyncio.run(run())
+
+    # The burst goes at once and the other 5 at 50 per second
+    assert started[-1] - started[0] >= 5 / 50 * 0.9
+
+def test_concurrency_is_limited():
+    scheduler = RequestScheduler(requests_per_second=1000, burst=1000, max_concurrency=3)
+    active = []
+    peak = []
+
+    async def request():
+        active.append(None)
+        peak.append(len(active))
+        await asyncio.sleep(0.01)
+        active.pop()
+
+    async def run():
+        await asyncio.gather(*[scheduler.run(request) for _ in range(20)])
+    asyncio.run(run())
+    assert max(peak) <= 3
+
+def test_concurrency_grows_on_fast_requests_and_halves_on_throttles():
+    scheduler = RequestScheduler(requests_per_second=1000, burst=4, max_concurrency=20, target_latency=1.0)
+    assert scheduler.concurrency == 4
+
+    async def fast():
+        pass
+    async def run():
+        for _ in range(20):
+            await scheduler.run(fast)
+    asyncio.run(run())
+    grown = scheduler.concurrency
+    assert grown > 4
+
+    throttled = []
+    async def throttle_once():
+        if len(throttled) == 0:
+            throttled.append(None)
+            raise ConnectionError()
+    scheduler.retry_policy = lambda e: (True, 0.01)
+    asyncio.run(scheduler.run(throttle_once))
+    assert scheduler.concurrency == max(1, grown // 2)
+    assert scheduler.stats.throttles == 1
+
+def test_retries_are_bounded():
+    scheduler = RequestScheduler(requests_per_second=1000, burst=10, max_retries=2, base_backoff=0.001, retry_policy=lambda e: (False, None))
+    attempts = []
+
+    async def request():
+        attempts.append(None)
+        raise ConnectionError()
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(scheduler.run(request))
+    assert len(attempts) == 3
+    assert scheduler.stats.failures == 1
+    assert scheduler._active == 0
+
+def test_concurrency_shrinks_on_retried_errors():
+    scheduler = RequestScheduler(requests_per_second=1000, burst=8, max_concurrency=20, min_concurrency=2, base_backoff=0.001, retry_policy=lambda e: (False, None))
+    assert scheduler.concurrency == 8
+    attempts = []
+
+    async def unstable():
+        attempts.append(None)
+        if len(attempts) <= 3:
+            raise TimeoutError()
+
+    asyncio.run(scheduler.run(unstable))
+    assert scheduler.concurrency == 8 - 3
+    assert scheduler.stats.throttles == 0
+
+    scheduler.concurrency = 2
+    attempts.clear()
+    asyncio.run(scheduler.run(unstable))
+    assert scheduler.concurrency == 2
@@ -0,0 +1,21 @@
+from pendo.core import RetryStats, backoff_delay, parse_retry_after
+from pendo.dataloaders.scheduler import SchedulerStats
+
+
+def test_backoff_prefers_the_server_delay():
+    assert backoff_delay(3, 1.0, 60.0, retry_after=2.5) == 2.5
+
+def test_backoff_is_jittered_and_capped():
+    delays = [backoff_delay(attempt, 1.0, 5.0) for attempt in range(10) for _ in range(20)]
+    assert all(0 <= delay <= 5.0 for delay in delays)
+    assert all(0 <= backoff_delay(0, 1.0, 5.0) <= 1.0 for _ in range(20))
+
+def test_parse_retry_after():
+    assert parse_retry_after({"retry-after": "3"}) == 3.0
+    assert parse_retry_after({"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"}) is None
+    assert parse_retry_after({}) is None
+    assert parse_retry_after(None) is None
+
+def test_stats():
+    assert str(RetryStats(requests=3, retries=1)) == "requests=3 throttles=0 retries=1 failures=0"
+    assert str(SchedulerStats(requests=2, total_latency=3.0)) == "requests=2 throttles=0 retries=0 failures=0 avg_latency=1.50s"
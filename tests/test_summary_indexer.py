@@ -0,0 +1,78 @@
+import asyncio
+import threading
+
+import pytest
+
+import pendo.indexers.summary as summary
+from pendo.dataloaders import ChunkedDoc
+from pendo.llms import Message, MessageRole
+
+
+class StubLlm():
+
+    def __init__(self, replies=None):
+        self.replies = list(replies or [])
+        self.requests = []
+
+    async def chat_completion_async(self, messages, **kwargs):
+        self.requests.append(messages)
+        reply = self.replies.pop(0) if len(self.replies) > 0 else f"summary {len(self.requests)}"
+        return Message(MessageRole.ASSISTANT, reply), None
+
+@pytest.fixture
+def indexer(monkeypatch, collection):
+    llm = StubLlm()
+    monkeypatch.setattr(summary, "get_llm", lambda name: llm)
+    indexer = summary.SummaryIndexer("summary")
+    indexer._index = collection
+    return indexer
+
+def _doc(id, text="text", tokens=10):
+    return ChunkedDoc(id, f"Title {id}", "2024-01-01", [text], metadata={"source": None, "date": "2024"}, chunk_tokens=[tokens])
+
+
+def test_summaries_are_upserted_off_the_event_loop(indexer, collection):
+    asyncio.run(indexer.index_docs([_doc("a"), _doc("b")]))
+
+    assert sorted(collection.entries) == ["a", "b"]
+    assert collection.entries["a"]["metadata"] == {"title": "Title a", "last_edited_time": "2024-01-01", "date": "2024"}
+    assert all(thread is not threading.main_thread() for method, thread in collection.calls if method == "upsert")
+
+@pytest.mark.parametrize("reply", [
+    '{"1": "First.", "2": "Second."}',
+    'Here are the summaries:\n{"1": " First. ", "2": "Second.", "3": "Ignored."}\nHope this helps!',
+])
+def test_packed_summaries_are_parsed(indexer, reply):
+    assert indexer._parse_packed_summaries(reply, 2) == ["First.", "Second."]
+
+@pytest.mark.parametrize("reply", [
+    "I cannot summarize these articles.",
+    '{"1": "First.", "2": "Second."',
+    '{"1": "First.", "2": Second.}',
+    '{} ["First.", "Second."] {}',
+    '{"1": "First."}',
+    '{"1": "First.", "2": "  "}',
+    '{"1": "First.", "2": ["Second."]}',
+])
+def test_unparsable_packed_summaries(indexer, reply):
+    assert indexer._parse_packed_summaries(reply, 2) is None
+
+def test_short_docs_are_summarized_together(indexer, collection):
+    indexer.pack_short_docs = True
+    # The long doc is summarized on its own, first
+    indexer.llm.replies = ["Summary of long.", '{"1": "Summary of a.", "2": "Summary of b."}']
+    asyncio.run(indexer.index_docs([_doc("a"), _doc("long", tokens=indexer.pack_doc_tokens + 1), _doc("b")]))
+
+    assert len(indexer.llm.requests) == 2
+    assert collection.entries["a"]["document"] == "Summary of a."
+    assert collection.entries["b"]["document"] == "Summary of b."
+    assert collection.entries["long"]["document"] == "Summary of long."
+
+def test_unparsable_pack_falls_back_to_one_summary_per_doc(indexer, collection):
+    indexer.pack_short_docs = True
+    indexer.llm.replies = ["Sorry, I can only summarize one article at a time."]
+    asyncio.run(indexer.index_docs([_doc("a"), _doc("b")]))
+
+    assert len(indexer.llm.requests) == 3
+    assert sorted(collection.entries) == ["a", "b"]
+    assert sorted(entry["document"] for entry in collection.entries.values()) == ["summary 2", "summary 3"]